@@ -0,0 +1,310 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Batch parsing of a corpus of .cnl and .tex documents.
+
+parse_corpus(paths) parses the files under paths in a pool of
+worker processes, and yields the results in input order as they
+become available.  Files go to the pool largest first, so that a big
+file is not left running alone at the end of the run.
+Each document is parsed in a session of its own (see ParserSession),
+as a list of statements (see production_rules.statements).
+
+parse_statements parses the statements of one document in parallel
+(see split_statements), in a pool of threads, optionally through
+a cache of statement results on disk (see parse_cache).
+
+usage: python batch.py [-j workers] [-s] [--cache dir] [-o file] [--profile] [-q]
+                       [files or directories]
+The default corpus is sample-texts/planet-math-11 and parser/scripts.
+Prints a line per file and the throughput of the run,
+and with --profile the time spent in each production.
+"""
+
+import sys
+import os
+import time
+import argparse
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import lib
+import lexer
+import parse_cache
+import parse_format
+import parser_combinator as c
+from parser_combinator import Parse
+import production_rules as p
+import vocabulary
+from vocabulary import default_corpus
+
+SUFFIXES = ('.cnl','.tex')
+
+def corpus_files(paths,suffixes=SUFFIXES):
+    """the .cnl and .tex files of the corpus paths (see vocabulary.corpus_files)"""
+    return vocabulary.corpus_files(paths,suffixes)
+
+def file_size(path) -> int:
+    try:
+        return os.path.getsize(path)
+    except OSError:
+        return 0
+
+# The result of parsing a file.
+# acc is the list of statements, None if the parse failed with error.
+# cached is the number of statements found in the cache.
+DocResult = namedtuple('DocResult','path size tokens acc error seconds cached')
+
+# the cache of each directory, in this process
+_caches = {}
+
+def open_cache(directory) -> parse_cache.ParseCache:
+    cache = _caches.get(directory)
+    if cache is None:
+        cache = _caches[directory] = parse_cache.ParseCache(directory)
+    return cache
+
+def parse_tokens(pr,toks,session):
+    """Run parser pr on all of toks in session: (acc,None), or (None,error)"""
+    try:
+        with session:
+            return ((pr + Parse.finished()).treat(lib.fst).process(c.init_item(toks)).acc,None)
+    except c.ParseError as e:
+        return (None,f'parse error at token {e.args[0].pos}')
+    except c.ParseNoCatch as e:
+        return (None,f'parse error: {e.msg}')
+    except StopIteration:
+        return (None,'unexpected end of input')
+
+def parse_document(toks,session,split=False,cache=None):
+    """(acc,error) of the parse of the tokens of a document in session,
+    statement by statement if split (see parse_statements)."""
+    if split:
+        rs = parse_statements(toks,session=session,cache=cache)
+        errs = [r for r in rs if r.error is not None]
+        if errs:
+            return ([r.acc for r in rs],
+                    f'{len(errs)} of {len(rs)} statements failed, first: {errs[0].error}')
+        return ([r.acc for r in rs],None)
+    with session:
+        pr = p.statements()
+    return parse_tokens(pr,toks,session)
+
+def parse_file(path,split=False,cache_dir=None) -> DocResult:
+    """Parse a file in a new session (see parse_document),
+    with the cache in cache_dir if given."""
+    t = time.perf_counter()
+    session = c.ParserSession()
+    cache = None if cache_dir is None else open_cache(cache_dir)
+    hits = None if cache is None else cache.hits
+    toks, acc, error = [], None, None
+    try:
+        toks = list(lexer.lex_file(path,lexer=session.tokenizer))
+    except (OSError,UnicodeDecodeError) as e:
+        error = str(e)
+    else:
+        (acc,error) = parse_document(toks,session,split,cache)
+    return DocResult(path,file_size(path),len(toks),acc,error,time.perf_counter() - t,
+                     None if cache is None else cache.hits - hits)
+
+def parse_corpus(paths,workers=None,split=False,cache_dir=None):
+    """Generate the DocResult of each file under paths, in input order.
+    The files are parsed in a pool of workers processes
+    (default one per cpu), largest first.
+    With workers=0 they are parsed in turn in this process.
+    A cache directory applies with split (see parse_file)."""
+    files = list(corpus_files(paths))
+    if workers == 0:
+        for f in files:
+            yield parse_file(f,split,cache_dir)
+        return
+    sizes = [file_size(f) for f in files]
+    pool = ProcessPoolExecutor(workers)
+    try:
+        futures = [None]*len(files)
+        for i in sorted(range(len(files)),key=lambda i : -sizes[i]):
+            futures[i] = pool.submit(parse_file,files[i],split,cache_dir)
+        for fut in futures:
+            yield fut.result()
+    finally:
+        pool.shutdown(cancel_futures=True)
+
+# intra-document parallelism
+
+# A statement of a document: the tokens start:stop.
+# ended is False for tokens after the last statement.
+# effect is True if parsing the statement may change the session.
+Statement = namedtuple('Statement','start stop ended effect')
+
+OPEN = ('(','[','{')
+CLOSE = (')',']','}')
+
+def cut_statements(tokens):
+    """Generate the statements of a token iterable as they end,
+    each as (tokens of the statement,ended,effect) (see split_statements).
+    Reads no token past the end of a statement."""
+    keywords = set(p.Instruction.keywords.split()).union(['synonym'])
+    window = []
+    depth = 0
+    instr = effect = False
+    for tok in tokens:
+        v = tok.value
+        window.append(tok)
+        n = len(window)
+        if n == 2:
+            instr = window[0].value == '[' and v in keywords
+            effect = effect or instr
+        elif n == 3:
+            effect = effect or (window[0].value == 'in' and window[1].value == 'this'
+                                and v in ('section','document'))
+        if v in OPEN:
+            depth += 1
+        elif v in CLOSE:
+            depth = max(depth - 1,0)
+        elif v == 'or' and n > 1 and window[-2].value == '(':
+            effect = True
+        if depth == 0 and (v == '.' or (instr and v == ']')):
+            yield (window,True,effect)
+            window = []
+            instr = effect = False
+    if window:
+        yield (window,False,effect)
+
+def split_statements(toks) -> list:
+    """Split a token list into statements, in one pass.
+    A statement ends with a period at bracket depth 0.  An instruction
+    '[keyword ...]' at the start of a statement is a statement of its own.
+    Tokens after the last statement make a last statement.
+    
+    Statements with side effects are marked: instructions,
+    scoping 'In this section/document', and word patterns that 
+    declare synonyms with '(or word)'."""
+    sts = []
+    start = 0
+    for (window,ended,effect) in cut_statements(toks):
+        sts.append(Statement(start,start + len(window),ended,effect))
+        start += len(window)
+    return sts
+
+# The result of parsing a statement, as for DocResult.
+StatementResult = namedtuple('StatementResult','start stop acc error')
+
+def parse_statement(toks,st,prs,session,cache=None) -> StatementResult:
+    """Parse statement st of toks in session, with prs() 
+    or, if st is not ended, as balanced tokens.
+    With a cache, the result is looked up first, and stored."""
+    if not(st.ended):
+        prs = c.balanced
+    stoks = toks[st.start:st.stop]
+    if cache is not None:
+        key = cache.key(stoks,prs,session)
+        hit = cache.get(key,stoks)
+        if hit is not None:
+            return StatementResult(st.start,st.stop,*hit)
+    with session:
+        pr = prs()
+    (acc,error) = parse_tokens(pr,stoks,session)
+    if cache is not None:
+        cache.put(key,stoks,(acc,error))
+    return StatementResult(st.start,st.stop,acc,error)
+
+def parse_apart(toks,sts,idxs,prs,session,workers=None,cache=None) -> list:
+    """Results of the statements sts[i] for i in idxs, 
+    parsed in a pool of workers threads, each in a fork of session.
+    The statements must have no side effects."""
+    with ThreadPoolExecutor(workers) as pool:
+        return list(pool.map(lambda i : parse_statement(toks,sts[i],prs,session.fork(),cache),
+                             idxs))
+
+def parse_statements(toks,prs=p.top_statement,session=None,workers=None,cache=None) -> list:
+    """Parse the statements of a token list (see split_statements),
+    returning a StatementResult for each, in document order.
+    prs() gives the parser of a statement; tokens after the last
+    statement are parsed as balanced tokens, as in statements.
+    
+    The statements with side effects are parsed first, in order, 
+    in session (default a new session).  The others are then parsed 
+    apart (see parse_apart): they see the synonyms and instructions
+    of the whole document, and number their meta-variables from 0.
+    Only they go through cache, if given."""
+    session = session or c.ParserSession()
+    sts = split_statements(toks)
+    results = [None]*len(sts)
+    for (i,st) in enumerate(sts):
+        if st.effect:
+            results[i] = parse_statement(toks,st,prs,session)
+    rest = [i for (i,st) in enumerate(sts) if not(st.effect)]
+    for (i,r) in zip(rest,parse_apart(toks,sts,rest,prs,session,workers,cache)):
+        results[i] = r
+    return results
+
+class Throughput:
+    """Totals of a run, for the report"""
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.files = 0
+        self.bytes = 0
+        self.tokens = 0
+        self.errors = 0
+        self.busy = 0.0 # seconds spent parsing, summed over files
+        self.statements = 0 # of the files parsed through a cache
+        self.cached = 0
+
+    def add(self,r:DocResult):
+        self.files += 1
+        self.bytes += r.size
+        self.tokens += r.tokens
+        self.errors += r.error is not None
+        self.busy += r.seconds
+        if r.cached is not None and r.acc is not None:
+            self.statements += len(r.acc)
+            self.cached += r.cached
+
+    def report(self) -> str:
+        secs = max(time.perf_counter() - self.start,1e-9)
+        return (f'{self.files} files, {self.tokens} tokens, {self.errors} errors '
+                f'in {secs:.3f}s: {self.files/secs:.1f} files/s, '
+                f'{self.tokens/secs:.0f} tokens/s, {self.bytes/secs/1e6:.2f} MB/s '
+                f'(parallelism {self.busy/secs:.2f})' +
+                (f', cache hits {self.cached} of {self.statements}' if self.statements else ''))
+
+def main(argv):
+    ap = argparse.ArgumentParser(description='Parse a corpus of CNL documents.')
+    ap.add_argument('paths',nargs='*',default=default_corpus,
+                    help='files, or directories searched for .cnl and .tex files')
+    ap.add_argument('-j','--workers',type=int,default=None,
+                    help='worker processes (default one per cpu, 0 for none)')
+    ap.add_argument('-s','--split',action='store_true',
+                    help='parse the statements of each file in parallel')
+    ap.add_argument('--cache',metavar='dir',default=None,
+                    help='cache statement results in dir (implies -s)')
+    ap.add_argument('-o','--output',metavar='file',default=None,
+                    help='write (path,acc,error) of each file to file (see parse_format)')
+    ap.add_argument('--profile',action='store_true',
+                    help='profile the productions, in this process (implies -j 0)')
+    ap.add_argument('-q','--quiet',action='store_true',
+                    help='print the report only')
+    args = ap.parse_args(argv[1:])
+    if args.profile:
+        args.workers = 0
+        c.profiler.enable()
+    stats = Throughput()
+    split = args.split or args.cache is not None
+    out = None if args.output is None else open(args.output,'wb')
+    writer = None if out is None else parse_format.Writer(out)
+    for r in parse_corpus(args.paths,args.workers,split,args.cache):
+        stats.add(r)
+        if writer is not None:
+            writer.write((r.path,r.acc,r.error))
+        if not(args.quiet):
+            status = r.error or f'{len(r.acc)} statements'
+            print(f'{r.path}: {r.tokens} tokens, {status}')
+    if out is not None:
+        out.close()
+    print(stats.report())
+    if args.profile:
+        print(c.profiler.report())
+    return 1 if stats.errors else 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
@@ -0,0 +1,63 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Benchmark of the compiled backend (vm) against the closure engine.
+
+Runs a few parsers from every step-th position of a token stream 
+with both engines, checks that they agree, and prints the times.
+
+usage: python bench_vm.py [file.cnl] [repeats] [step]
+"""
+
+import sys
+import time
+import lexer
+import parser_combinator as c
+import production_rules as p
+import vm
+
+def parsers():
+    w = c.next_any_word()
+    yield 'words', w.many()
+    yield 'balanced', c.balanced()
+    yield 'transition', p.phrase_list_transition() + w.many()
+    yield 'comma list', c.comma_nonempty_list(w)
+    yield 'lits', (p.lit_dict['iff'] | p.lit_dict['we-say'] |
+                   p.lit_dict['assume'] | w).plus()
+
+def outcome(process,item):
+    try:
+        r = process(item)
+        return (r.pos,repr(r.acc))
+    except (c.ParseError,c.ParseNoCatch,StopIteration) as e:
+        return type(e)
+
+def timed(process,items,repeats):
+    t = time.perf_counter()
+    for _ in range(repeats):
+        for item in items:
+            try:
+                process(item)
+            except (c.ParseError,c.ParseNoCatch,StopIteration):
+                pass
+    return time.perf_counter() - t
+
+def main(argv):
+    fname = argv[1] if len(argv) > 1 else '../parser/scripts/sylow.cnl'
+    repeats = int(argv[2]) if len(argv) > 2 else 3
+    step = int(argv[3]) if len(argv) > 3 else 10
+    toks = list(lexer.lex_file(fname))
+    item = c.init_item(toks)
+    items = [c.Item(item.stream,i,None,item.history) for i in range(0,len(toks),step)]
+    print(f'{len(toks)} tokens, {len(items)} starts, {repeats} repeats')
+    print(f'{"parser":12} {"closures":>9} {"vm":>9} {"speedup":>8}')
+    for (name,pr) in parsers():
+        prog = vm.compile(pr)
+        for it in items:
+            assert outcome(pr.process,it) == outcome(prog.process,it), (name,it.pos)
+        t0 = timed(pr.process,items,repeats)
+        t1 = timed(prog.process,items,repeats)
+        print(f'{name:12} {t0:9.3f} {t1:9.3f} {t0/t1:8.2f}')
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -0,0 +1,196 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Incremental re-parsing of a document after edits.
+
+A Document keeps its text, tokens, statements (see batch.split_statements)
+and their parse results.  After an edit, the text is lexed again only
+from the start of the statement holding the edit, up to the first old
+statement boundary past the edit where the new tokens fall back in step.
+The tokens after it are kept, shifted.  The statements of the region
+are parsed again, and with them the statements that a change of
+synonyms or instructions can affect.  Other results are kept.
+
+usage: python incremental.py file.cnl [interval]
+Watches the file, and reports what is parsed again after each change.
+"""
+
+import sys
+import time
+import bisect
+import lexer
+import parser_combinator as c
+import production_rules as p
+import batch
+
+def common_prefix(a:str,b:str,limit=None) -> int:
+    """length of the common prefix of a and b, at most limit"""
+    lo, hi = 0, min(len(a),len(b),len(a) if limit is None else limit)
+    while lo < hi:
+        mid = (lo + hi + 1) // 2
+        if a[lo:mid] == b[lo:mid]:
+            lo = mid
+        else:
+            hi = mid - 1
+    return lo
+
+def common_suffix(a:str,b:str,limit=None) -> int:
+    """length of the common suffix of a and b, at most limit"""
+    lo, hi = 0, min(len(a),len(b),len(a) if limit is None else limit)
+    while lo < hi:
+        mid = (lo + hi + 1) // 2
+        if a[len(a)-mid:len(a)-lo] == b[len(b)-mid:len(b)-lo]:
+            lo = mid
+        else:
+            hi = mid - 1
+    return lo
+
+def changed_words(t1,t2) -> set:
+    """words with another canonical form in synonym table t2 than in t1"""
+    return {w for w in set(t1.cls).union(t2.cls)
+            if t1.canonical(w,w) != t2.canonical(w,w)}
+
+def _lexpos(tok):
+    return tok.lexpos
+
+def _start(st):
+    return st.start
+
+class Document:
+    """A document kept parsed across edits.
+    statements and results are as given by batch.split_statements and
+    batch.parse_statements on toks, with prs() parsing a statement."""
+
+    def __init__(self,text,prs=p.top_statement,workers=None):
+        self.prs = prs
+        self.workers = workers
+        self.text = text
+        self.session = c.ParserSession()
+        self.toks = self.session.lex(text)
+        self.statements = batch.split_statements(self.toks)
+        self.results = batch.parse_statements(self.toks,prs,self.session,workers)
+
+    def _relex(self,text,a,b,new,r,line):
+        """Lex text from position r at line line, up to the start of the
+        first old statement past the edit of text[a:b] to new where the
+        new tokens are in step with the old.
+        Returns the new tokens, the index of that statement, and the
+        change of the line numbers of its tokens (which is not the
+        change of the count of newlines, as the lexer does not count
+        those in strings)."""
+        toks, sts = self.toks, self.statements
+        delta = len(new) - (b - a)
+        j = bisect.bisect_left(sts,b,key=lambda st : toks[st.start].lexpos)
+        lx = self.session.tokenizer
+        lx.input(text)
+        lx.lexpos = r
+        lx.lineno = line
+        region = []
+        depth = 0
+        for raw in lx:
+            tok = lexer.Token.of(raw)
+            q = tok.lexpos - delta
+            while j < len(sts) and toks[sts[j].start].lexpos < q:
+                j += 1
+            if (j < len(sts) and toks[sts[j].start].lexpos == q and depth == 0
+                and (len(region) == 0 or region[-1].value in ('.',']'))
+                and all(st.ended for st in batch.split_statements(region))):
+                return (region,j,tok.lineno - toks[sts[j].start].lineno)
+            if tok.value in batch.OPEN:
+                depth += 1
+            elif tok.value in batch.CLOSE:
+                depth = max(depth - 1,0)
+            region.append(tok)
+        return (region,len(sts),0)
+
+    def _open_quote(self,a):
+        """Position of the unterminated quote before a, or None.
+        The lexer skips a quote with no quote after it, so it can only
+        be the last quote of the text, and not the end of a string."""
+        q = self.text.rfind('"',0,a)
+        if q < 0 or self.text.find('"',q + 1) >= 0:
+            return None
+        i = bisect.bisect_right(self.toks,q,key=_lexpos) - 1
+        if (i >= 0 and self.toks[i].type == 'STRING'
+            and self.toks[i].lexpos + len(self.toks[i].value) > q):
+            return None
+        return q
+
+    def edit(self,a,b,new) -> list:
+        """Replace text[a:b] by new, and parse again what the edit changes.
+        Returns the indices of the statements parsed again."""
+        toks, sts, results = self.toks, self.statements, self.results
+        text = self.text[:a] + new + self.text[b:]
+        delta = len(new) - (b - a)
+        # the statement of the last token starting before a,
+        # which the edit can run on to
+        k = bisect.bisect_left(toks,a,key=_lexpos) - 1
+        q = self._open_quote(a)
+        if q is not None and '"' in new:
+            # a quote in new can close it, making a string from it
+            k = min(k,bisect.bisect_left(toks,q,key=_lexpos) - 1)
+        i0 = max(bisect.bisect_right(sts,k,key=_start) - 1,0)
+        (t0,r,line) = (0,0,1) if i0 == 0 else (sts[i0].start,toks[sts[i0].start].lexpos,toks[sts[i0].start].lineno)
+        (region,j,dlines) = self._relex(text,a,b,new,r,line)
+        tail = sts[j].start if j < len(sts) else len(toks)
+        for tok in toks[tail:]:
+            tok.lexpos += delta
+            tok.lineno += dlines
+        dt = len(region) - (tail - t0)
+        new_toks = toks[:t0] + region + toks[tail:]
+        region_sts = [st._replace(start=st.start + t0,stop=st.stop + t0)
+                      for st in batch.split_statements(region)]
+        new_sts = (sts[:i0] + region_sts +
+                   [st._replace(start=st.start + dt,stop=st.stop + dt) for st in sts[j:]])
+        new_results = (results[:i0] + [None]*len(region_sts) +
+                       [rs._replace(start=rs.start + dt,stop=rs.stop + dt) for rs in results[j:]])
+        i1 = i0 + len(region_sts)
+        redo = set(range(i0,i1))
+        effects = [i for (i,st) in enumerate(new_sts) if st.effect]
+        if any(st.effect for st in sts[i0:j]) or any(st.effect for st in region_sts):
+            # run the declarations again, in a new session
+            session = c.ParserSession()
+            for i in effects:
+                new_results[i] = batch.parse_statement(new_toks,new_sts[i],self.prs,session)
+            words = changed_words(self.session.synonyms,session.synonyms)
+            for (i,st) in enumerate(new_sts):
+                if any(tok.value.lower() in words for tok in new_toks[st.start:st.stop]):
+                    redo.add(i)
+            if session.instruct != self.session.instruct:
+                redo.update(range(i0,len(new_sts)))
+            redo.update(effects)
+            self.session = session
+        apart = sorted(i for i in redo if not(new_sts[i].effect))
+        for (i,rs) in zip(apart,batch.parse_apart(new_toks,new_sts,apart,self.prs,
+                                                  self.session,self.workers)):
+            new_results[i] = rs
+        self.text, self.toks, self.statements, self.results = text, new_toks, new_sts, new_results
+        return sorted(redo)
+
+    def update(self,text) -> list:
+        """Change the text to text, as a single edit (see edit)."""
+        n = common_prefix(self.text,text)
+        m = common_suffix(self.text,text,min(len(self.text),len(text)) - n)
+        return self.edit(n,len(self.text) - m,text[n:len(text) - m])
+
+def main(argv):
+    fname = argv[1]
+    interval = float(argv[2]) if len(argv) > 2 else 0.5
+    with open(fname,encoding='utf-8') as fp:
+        t = time.perf_counter()
+        doc = Document(fp.read())
+    print(f'{len(doc.statements)} statements parsed in {time.perf_counter() - t:.3f}s')
+    while True:
+        time.sleep(interval)
+        with open(fname,encoding='utf-8') as fp:
+            text = fp.read()
+        if text == doc.text:
+            continue
+        t = time.perf_counter()
+        redo = doc.update(text)
+        errs = sum(rs.error is not None for rs in doc.results)
+        print(f'{len(redo)} of {len(doc.statements)} statements parsed again '
+              f'in {time.perf_counter() - t:.3f}s, {errs} errors')
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -6,10 +6,18 @@ Created on Tue Aug  4 09:24:36 2020
 @author: thales
 """
 
-import ply.lex as lex
 import msg
 import word_lists
 import re
+import os
+import bisect
+import mmap
+import functools
+import zlib
+import json
+import importlib.util
+import sys
+from array import array
 
 # XX we should be able to collapse keyword symbol into a single token class'
 # MID TMID ASSIGN ARROW BLANK ALT COLON APPLYSUB etc.
@@ -31,7 +39,7 @@ tokens = (
     'PERIOD',
     'COLON',
     'APPLYSUB',
-    #'SLASH',
+    'SLASH',
     #'SLASHDASH',
     'COERCION',
     'LAMBDA',
@@ -63,7 +71,7 @@ singularize_patterns = [
         ]
     ]
 
-def singularize(s):
+def singularize_uncached(s):
     s = s.lower()
     if len(s) <= 3 or not(s.endswith('s')) or s in word_lists.singular:
         return s
@@ -72,6 +80,43 @@ def singularize(s):
         if match:
             return match.group(1)+e
 
+# Singular forms are looked up first in the vocabulary table 
+# (built by vocabulary.py from a corpus), then in a bounded cache.
+
+SINGULAR_CACHE_SIZE = 1 << 16
+
+VOCABULARY_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)),'vocabulary.json')
+
+vocabulary = {}
+
+_singularize_cached = functools.lru_cache(maxsize=SINGULAR_CACHE_SIZE)(singularize_uncached)
+
+def singularize(s):
+    r = vocabulary.get(s)
+    if r is None:
+        return _singularize_cached(s)
+    return r
+
+def vocabulary_fingerprint():
+    """Hash of the rules of singularize_uncached. 
+    A vocabulary table built under other rules is not loaded."""
+    rules = [(p.pattern,e) for (p,e) in singularize_patterns] + sorted(word_lists.singular)
+    return '%08x' % zlib.crc32(json.dumps(rules).encode('utf-8'))
+
+def load_vocabulary(filename=VOCABULARY_FILE):
+    """Load a vocabulary table written by vocabulary.py.
+    Returns the number of entries, or 0 if the file is missing or stale."""
+    try:
+        with open(filename,encoding='utf-8') as fp:
+            data = json.load(fp)
+    except (OSError,ValueError):
+        return 0
+    if data.get('fingerprint') != vocabulary_fingerprint():
+        return 0
+    vocabulary.clear()
+    vocabulary.update(data['words'])
+    return len(vocabulary)
+
 
 t_ignore_COMMENT = '%.*'
  
@@ -83,8 +128,7 @@ def t_newline(t):
  #     input is the input text string
  #     token is a token instance
 def find_column(input, token):
-     line_start = input.rfind('\n', 0, token.lexpos) + 1
-     return (token.lexpos - line_start) + 1
+     return source_map(input).column(token.lexpos)
  
 t_ignore = ' \t\r\f\v'
 
@@ -185,16 +229,464 @@ def t_CONTROLSEQ(t):
     t.type = reserved_control.get(t.value,'CONTROLSEQ')
     return t 
 
-tokenizer = lex.lex()
-
-
-
-
-
-
-
-
-
-
-
-
+# Lexer tables.
+# ply builds the lexer by reflection over this module, which is slow.
+# In its optimize mode, it writes the tables it builds to a module, 
+# and builds the lexer from that module next time.  ply does not check 
+# that a table module is that of the current rules, so the module is 
+# kept in LEX_CACHE_DIR under a fingerprint of this file.
+# Set the environment variable CNL_FAST_START=0 to always build from the rules.
+
+FAST_START = os.environ.get('CNL_FAST_START','1') != '0'
+
+LEX_CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),'__lexcache__')
+
+def lex_cache_name():
+    """name of the table module of the current source of this module"""
+    with open(os.path.abspath(__file__),'rb') as fp:
+        return 'lextab_%08x' % zlib.crc32(fp.read())
+
+def load_lex_tables(name):
+    """table module name from LEX_CACHE_DIR, or None"""
+    spec = importlib.util.spec_from_file_location(name,os.path.join(LEX_CACHE_DIR,name + '.py'))
+    try:
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+    except (OSError,SyntaxError): # missing, or being written
+        return None
+    return module
+
+def make_tokenizer(fast=FAST_START):
+    """ply lexer, built in optimize mode from the cached table module,
+    or else built and its table module cached"""
+    import ply.lex as lex
+    module = sys.modules[__name__]
+    if not(fast):
+        return lex.lex(module=module)
+    name = lex_cache_name()
+    tables = load_lex_tables(name)
+    if tables is not None and getattr(tables,'_tabversion',None) == lex.__tabversion__:
+        return lex.lex(module=module,optimize=1,lextab=tables)
+    try:
+        os.makedirs(LEX_CACHE_DIR,exist_ok=True)
+    except OSError:
+        return lex.lex(module=module)
+    tmp = f'{name}_{os.getpid()}' # written whole, then renamed
+    lx = lex.lex(module=module,optimize=1,lextab=tmp,outputdir=LEX_CACHE_DIR)
+    try:
+        os.replace(os.path.join(LEX_CACHE_DIR,tmp + '.py'),os.path.join(LEX_CACHE_DIR,name + '.py'))
+        for f in os.listdir(LEX_CACHE_DIR):
+            if f.startswith('lextab') and f != name + '.py' and not(f.startswith(name + '_')):
+                os.remove(os.path.join(LEX_CACHE_DIR,f))
+    except OSError:
+        pass
+    return lx
+
+tokenizer = make_tokenizer()
+
+load_vocabulary()
+
+# compact tokens
+
+type_codes = {}
+type_names = []
+
+def type_code(ty) -> int:
+    """integer code of a token type; new types get the next code"""
+    code = type_codes.get(ty)
+    if code is None:
+        code = len(type_names)
+        type_codes[ty] = code
+        type_names.append(sys.intern(ty))
+    return code
+
+for _ty in tokens + tuple(literals) + ('META',):
+    type_code(_ty)
+
+class Token:
+    """Token with slots in place of ply's LexToken, 
+    printing the same way.  
+    type and value strings are interned.  rawvalue is the value as 
+    written, before singularization."""
+    __slots__ = ('type','value','lineno','lexpos','rawvalue')
+    
+    def __init__(self,type,value,lineno=0,lexpos=0,rawvalue=None):
+        self.type = type
+        self.value = value
+        self.lineno = lineno
+        self.lexpos = lexpos
+        self.rawvalue = value if rawvalue is None else rawvalue
+        
+    def of(tok,offset=0):
+        """compact copy of a ply token, with lexpos shifted by offset"""
+        value = tok.value
+        if value.__class__ is str:
+            value = sys.intern(value)
+        return Token(type_names[type_code(tok.type)],value,tok.lineno,
+                     tok.lexpos + offset,getattr(tok,'rawvalue',None))
+    
+    @property
+    def code(self):
+        return type_code(self.type)
+        
+    def __str__(self):
+        return 'LexToken(%s,%r,%d,%d)' % (self.type,self.value,self.lineno,self.lexpos)
+    
+    def __repr__(self):
+        return str(self)
+
+class DerivedToken(Token):
+    """View of a token with another type and value, such as a 
+    wordified token.  Position and raw value are read from the base 
+    token, so deriving copies nothing else."""
+    __slots__ = ('base',)
+    
+    def __init__(self,base,type,value):
+        self.base = base
+        self.type = type
+        self.value = value
+        
+    lineno = property(lambda self : self.base.lineno)
+    lexpos = property(lambda self : self.base.lexpos)
+    rawvalue = property(lambda self : self.base.rawvalue)
+    
+    def __reduce__(self):
+        return (DerivedToken,(self.base,self.type,self.value))
+    
+class AttrToken(Token):
+    """Token that takes attributes beyond those of Token, such as the
+    annotation of a variable.  Tokens are kept compact otherwise."""
+    
+    def of_token(tok):
+        """copy of tok, a token of any kind, with its extra attributes"""
+        t = AttrToken(tok.type,tok.value,tok.lineno,tok.lexpos,getattr(tok,'rawvalue',None))
+        t.__dict__.update(getattr(tok,'__dict__',{}))
+        return t
+    
+def derive(tok,type,value):
+    """token tok, viewed with another type and value"""
+    if tok.__class__ is DerivedToken:
+        tok = tok.base
+    return DerivedToken(tok,type,value)
+
+class TokenStream:
+    """Struct of arrays holding a token list: type codes, 
+    ids of values in a table of strings, line numbers and positions.
+    Raw values are kept only where they differ from the value.
+    Indexing builds Token objects, so the parsers can run on a stream."""
+    __slots__ = ('codes','ids','linenos','lexposes','raw','strings','_id')
+    
+    def __init__(self,toks=()):
+        self.codes = array('H')
+        self.ids = array('L')
+        self.linenos = array('L')
+        self.lexposes = array('Q')
+        self.raw = {}
+        self.strings = []
+        self._id = {}
+        for tok in toks:
+            self.append(tok)
+    
+    def _string_id(self,s):
+        i = self._id.get(s)
+        if i is None:
+            i = len(self.strings)
+            self._id[s] = i
+            self.strings.append(sys.intern(s))
+        return i
+            
+    def append(self,tok):
+        self.raw_append(type_code(tok.type),tok.value,tok.lineno,tok.lexpos,
+                        getattr(tok,'rawvalue',tok.value))
+        
+    def raw_append(self,code,value,lineno,lexpos,rawvalue):
+        if rawvalue != value:
+            self.raw[len(self.codes)] = rawvalue
+        self.codes.append(code)
+        self.ids.append(self._string_id(value))
+        self.linenos.append(lineno)
+        self.lexposes.append(lexpos)
+        
+    def __len__(self):
+        return len(self.codes)
+    
+    def __getitem__(self,i):
+        if isinstance(i,slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        if i < 0:
+            i += len(self)
+        return Token(type_names[self.codes[i]],self.strings[self.ids[i]],
+                     self.linenos[i],self.lexposes[i],self.raw.get(i))
+    
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+class TokenSpan:
+    """The tokens start:stop of a token stream, standing for the list
+    of them, which is only built when asked for (see tokens).
+    A span reads as a list: it indexes, iterates, compares and prints
+    as one.  Slicing gives a span, adding gives a list."""
+    __slots__ = ('stream','start','stop')
+
+    def __init__(self,stream,start,stop):
+        if stream.__class__ is TokenSpan: # a span of a span is a span of its stream
+            (stream,start,stop) = (stream.stream,stream.start + start,stream.start + stop)
+        self.stream = stream
+        self.start = start
+        self.stop = stop
+
+    def tokens(self) -> list:
+        return list(self.stream[self.start:self.stop])
+
+    def __len__(self):
+        return self.stop - self.start
+
+    def __getitem__(self,i):
+        if isinstance(i,slice):
+            (a,b,step) = i.indices(len(self))
+            if step == 1:
+                return TokenSpan(self.stream,self.start + a,self.start + max(a,b))
+            return self.tokens()[i]
+        if i < 0:
+            i += len(self)
+        if not(0 <= i < len(self)):
+            raise IndexError('span index out of range')
+        return self.stream[self.start + i]
+
+    def __iter__(self):
+        stream = self.stream
+        for i in range(self.start,self.stop):
+            yield stream[i]
+
+    def __add__(self,other):
+        return self.tokens() + list(other)
+
+    def __radd__(self,other):
+        return list(other) + self.tokens()
+
+    def __eq__(self,other):
+        if isinstance(other,(TokenSpan,list)):
+            return len(self) == len(other) and all(a == b for (a,b) in zip(self,other))
+        return NotImplemented
+
+    __hash__ = None
+
+    def __repr__(self):
+        return repr(self.tokens())
+
+    def __reduce__(self):
+        return (list,(self.tokens(),))
+
+# streaming front end for large files
+
+CHUNK_SIZE = 1 << 20
+
+# regions of the input inside which lexing cannot be split
+_protected = re.compile(rb'\[TeX2Cnl(?:Error|Warning)\s*"[^"]*"\s*\]|"[^"]*"?|%[^\n]*')
+
+def safe_cut(data:bytes):
+    """Offset just past the last newline of data[:-1] 
+    at which lexing may be split, or None.  
+    The newline must be outside strings (which may span lines), 
+    and the next character must not continue a token across it.
+    data must start at a safe point."""
+    return _scan_cut(data)[0]
+
+def _scan_cut(data,start=0,since=0):
+    """safe_cut of data, scanning for protected regions from start
+    (a point outside them) and looking at the newlines from since only.
+    Returns (cut,resume,closer): resume is where a scan of data with
+    more input after it may start, and closer the byte that ends the
+    protected region open at the end of data, if any."""
+    n = len(data)
+    strings = []
+    (resume,closer) = (start,None)
+    for m in _protected.finditer(data,start):
+        (a,b) = m.span()
+        if data[a] != ord('%'):
+            strings.append((a,b))
+        if b < n or data[a] == ord('[') or (data[a] == ord('"') and b - a > 1 
+                                             and data[b-1] == ord('"')):
+            resume = b
+        else:
+            (resume,closer) = (a,b'"' if data[a] == ord('"') else b'\n')
+    starts = [a for (a,_) in strings]
+    lo = max(start,since)
+    i = data.rfind(b'\n',lo,n-1)
+    while i >= 0:
+        if not(data[i+1] in b' \t\r\f\v\n]'):
+            k = bisect.bisect_right(starts,i) - 1
+            if k < 0 or strings[k][1] <= i:
+                return (i + 1,resume,closer)
+        i = data.rfind(b'\n',lo,i)
+    return (None,resume,closer)
+
+_space = re.compile(rb'\s')
+
+def _forced_cut(data):
+    """Offset past the last whitespace of data outside strings and 
+    comments, or None"""
+    (gaps,a) = ([],0)
+    for m in _protected.finditer(data):
+        gaps.append((a,m.start()))
+        a = m.end()
+    gaps.append((a,len(data)))
+    for (a,b) in reversed(gaps):
+        m = None
+        for m in _space.finditer(data,a,b):
+            pass
+        if m is not None:
+            return m.end()
+    return None
+
+def lex_buffer(buf,chunk_size=CHUNK_SIZE,lexer=None):
+    """Generate the (compact) tokens of utf-8 bytes buf (such as an mmap), 
+    lexing a chunk at a time.  Chunks are split at safe points 
+    (see safe_cut); lineno and lexpos are relative to the whole of buf,
+    lexpos counting characters as for lexer.input.
+    Runs on a clone of lexer (default tokenizer)."""
+    lx = (lexer or tokenizer).clone()
+    lx.lineno = 1
+    n = len(buf)
+    start = 0
+    offset = 0
+    while start < n:
+        size = chunk_size
+        while True:
+            end = start + size
+            if end >= n:
+                cut = n
+                break
+            cut = safe_cut(buf[start:end+1])
+            if cut is not None:
+                cut += start
+                break
+            size *= 2
+        text = buf[start:cut].decode('utf-8')
+        lx.input(text)
+        for tok in lx:
+            yield Token.of(tok,offset)
+        offset += len(text)
+        start = cut
+
+PENDING_MAX = 1 << 24
+
+def lex_chunks(chunks,lexer=None,max_pending=PENDING_MAX):
+    """Generate the (compact) tokens of an iterable of utf-8 bytes
+    chunks (such as reads of a file), as lex_buffer does for their
+    concatenation.  The input is lexed up to its last safe point
+    (see safe_cut) as chunks come, so that only the input after
+    it is held.  Each byte is scanned for safe points about once.
+    Past max_pending bytes with no safe point, the input is cut at 
+    its last whitespace outside strings; ValueError if there is none.
+    Runs on a clone of lexer (default tokenizer)."""
+    lx = (lexer or tokenizer).clone()
+    lx.lineno = 1
+    offset = 0
+    pending = bytearray()
+    (resume,closer) = (0,None)
+    def lex(cut):
+        nonlocal pending, offset
+        text = pending[:cut].decode('utf-8')
+        del pending[:cut]
+        lx.input(text)
+        for tok in lx:
+            yield Token.of(tok,offset)
+        offset += len(text)
+    for chunk in chunks:
+        n = len(pending)
+        pending += chunk
+        cut = None
+        if closer is not None:
+            # the region open at the end of pending may have closed
+            e = pending.find(closer,n)
+            if e >= 0:
+                (resume,closer) = (e + 1 if closer == b'"' else e,None)
+        if closer is None:
+            (cut,resume,closer) = _scan_cut(pending,resume,max(n - 1,0))
+        if cut is None and len(pending) > max_pending:
+            cut = _forced_cut(pending)
+            if cut is None:
+                raise ValueError(f'no point to split the input at in {len(pending)} bytes')
+        if cut is not None:
+            resume = max(resume - cut,0)
+            yield from lex(cut)
+    if pending:
+        yield from lex(len(pending))
+
+def lex_string(s,lexer=None):
+    """list of the compact tokens of s"""
+    lx = (lexer or tokenizer).clone()
+    lx.lineno = 1
+    lx.input(s)
+    return [Token.of(tok) for tok in lx]
+
+# source maps
+
+class SourceMap:
+    """Line start offsets of a text, built once, 
+    so that lines and columns are found by binary search.
+    Positions are character offsets, as in token lexpos.
+    Lines and columns count from 1."""
+    __slots__ = ('text','starts')
+    
+    def __init__(self,text):
+        self.text = text
+        self.starts = array('Q',[0])
+        i = text.find('\n')
+        while i >= 0:
+            self.starts.append(i + 1)
+            i = text.find('\n',i + 1)
+            
+    def line(self,pos) -> int:
+        return bisect.bisect_right(self.starts,pos)
+    
+    def column(self,pos) -> int:
+        return pos - self.starts[self.line(pos) - 1] + 1
+    
+    def location(self,pos):
+        """(line,column) of pos"""
+        line = bisect.bisect_right(self.starts,pos)
+        return (line,pos - self.starts[line - 1] + 1)
+    
+    def line_text(self,line) -> str:
+        """text of a line, without its newline"""
+        start = self.starts[line - 1]
+        end = self.starts[line] - 1 if line < len(self.starts) else len(self.text)
+        return self.text[start:end]
+    
+    def token_location(self,tok):
+        return self.location(tok.lexpos)
+    
+    def stream_location(self,stream,i):
+        """(line,column) of the i-th token of stream, 
+        or of the end of the last token if i == len(stream)"""
+        if i < len(stream):
+            return self.location(stream[i].lexpos)
+        if len(stream) == 0:
+            return self.location(0)
+        tok = stream[-1]
+        return self.location(tok.lexpos + len(str(getattr(tok,'rawvalue',tok.value))))
+    
+    def __len__(self):
+        """number of lines"""
+        return len(self.starts)
+
+def source_map(text) -> SourceMap:
+    """source map of text, reusing the last one built for the same text"""
+    smap = source_map.last
+    if smap is None or smap.text is not text:
+        smap = SourceMap(text)
+        source_map.last = smap
+    return smap
+
+source_map.last = None
+
+def lex_file(filename,chunk_size=CHUNK_SIZE,lexer=None):
+    """Generate the tokens of a file, read through mmap. See lex_buffer."""
+    with open(filename,'rb') as fp:
+        if os.fstat(fp.fileno()).st_size == 0:
+            return
+        with mmap.mmap(fp.fileno(),0,access=mmap.ACCESS_READ) as mm:
+            yield from lex_buffer(mm,chunk_size,lexer)
@@ -0,0 +1,202 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Content-addressed cache of statement parse results, on disk.
+
+A result is stored under a hash of
+  the types and values of the tokens of the statement,
+  the state of the session parsing it: synonyms and instructions,
+  the parser, and the grammar version (a fingerprint of the sources).
+Token positions are not part of the key.  The tokens of the statement
+are stored as their indices in the statement, so that a hit is rebuilt
+on the tokens of the statement being parsed, wherever it is.
+
+Entries are written atomically, one file each.  When the cache holds
+more than max_bytes, the least recently used entries are evicted.
+Statements with side effects on the session must not be cached.
+"""
+
+import os
+import io
+import sys
+import pickle
+import hashlib
+import threading
+
+CACHE_DIR = '__parsecache__'
+CACHE_BYTES = 64 * 2**20
+
+# sources that the parse of a statement depends on
+GRAMMAR_SOURCES = ['lexer.py','lib.py','word_lists.py',
+                   'parser_combinator.py','production_rules.py']
+
+here = os.path.dirname(os.path.abspath(__file__))
+
+_version = None
+
+def grammar_version() -> str:
+    """fingerprint of the grammar sources and of the python version"""
+    global _version
+    if _version is None:
+        h = hashlib.blake2b(sys.version.encode('utf-8'),digest_size=8)
+        for f in GRAMMAR_SOURCES:
+            with open(os.path.join(here,f),'rb') as fp:
+                h.update(fp.read())
+        _version = h.hexdigest()
+    return _version
+
+def parser_name(prs) -> str:
+    return f'{prs.__module__}.{prs.__qualname__}'
+
+class _Pickler(pickle.Pickler):
+    """pickles the tokens of a statement as their indices"""
+
+    def __init__(self,fp,toks):
+        super().__init__(fp,pickle.HIGHEST_PROTOCOL)
+        self.index = {id(tok) : i for (i,tok) in enumerate(toks)}
+
+    def persistent_id(self,obj):
+        return self.index.get(id(obj))
+
+class _Unpickler(pickle.Unpickler):
+
+    def __init__(self,fp,toks):
+        super().__init__(fp)
+        self.toks = toks
+
+    def persistent_load(self,i):
+        return self.toks[i]
+
+class ParseCache:
+    """Cache of parse results in directory, of at most max_bytes.
+    Safe to share between threads, and between processes on one directory."""
+
+    def __init__(self,directory=CACHE_DIR,max_bytes=CACHE_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.version = grammar_version()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.writes = 0
+        self.evictions = 0
+        self.bytes = sum(size for (_,_,size) in self._entries())
+
+    def key(self,toks,prs,session) -> str:
+        """key of the parse of toks with prs() in session"""
+        h = hashlib.blake2b(digest_size=20)
+        h.update(repr((self.version,parser_name(prs),session.synonyms.key,
+                       sorted(session.instruct.items()))).encode('utf-8'))
+        for tok in toks:
+            h.update(f'\0{tok.type}\0{tok.value}'.encode('utf-8'))
+        return h.hexdigest()
+
+    def path(self,key) -> str:
+        return os.path.join(self.directory,key[:2],key[2:])
+
+    def get(self,key,toks):
+        """the value stored under key, rebuilt on toks, or None"""
+        path = self.path(key)
+        try:
+            with open(path,'rb') as fp:
+                value = _Unpickler(fp,toks).load()
+            os.utime(path)
+        except FileNotFoundError:
+            value = None
+        except (OSError,EOFError,IndexError,pickle.UnpicklingError,AttributeError):
+            value = None # damaged entry
+            self._remove(path)
+        with self.lock:
+            if value is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return value
+
+    def put(self,key,toks,value):
+        """store value, the result of a parse of toks, under key"""
+        fp = io.BytesIO()
+        try:
+            _Pickler(fp,toks).dump(value)
+        except (pickle.PicklingError,TypeError,AttributeError):
+            return # not picklable, not cached
+        data = fp.getvalue()
+        path = self.path(key)
+        tmp = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+        try:
+            os.makedirs(os.path.dirname(path),exist_ok=True)
+            with open(tmp,'wb') as f:
+                f.write(data)
+            try:
+                old = os.stat(path).st_size # of the entry replaced
+            except FileNotFoundError:
+                old = 0
+            os.replace(tmp,path)
+        except OSError:
+            self._remove(tmp)
+            return
+        with self.lock:
+            self.writes += 1
+            self.bytes += len(data) - old
+            full = self.bytes > self.max_bytes
+        if full:
+            self.evict()
+
+    def evict(self,fraction=0.9):
+        """Remove the least recently used entries,
+        down to fraction of max_bytes."""
+        with self.lock:
+            entries = sorted(self._entries())
+            total = sum(size for (_,_,size) in entries)
+            for (_,path,size) in entries:
+                if total <= fraction * self.max_bytes:
+                    break
+                if self._remove(path):
+                    total -= size
+                    self.evictions += 1
+            self.bytes = total
+
+    def clear(self):
+        """Remove all entries and reset the counters"""
+        with self.lock:
+            for (_,path,_) in self._entries():
+                self._remove(path)
+            self.bytes = 0
+            self.hits = self.misses = self.writes = self.evictions = 0
+
+    def stats(self):
+        """Counters as a dictionary"""
+        looked = self.hits + self.misses
+        return {'bytes' : self.bytes,
+                'capacity' : self.max_bytes,
+                'hits' : self.hits,
+                'misses' : self.misses,
+                'hit_rate' : self.hits / looked if looked else 0.0,
+                'writes' : self.writes,
+                'evictions' : self.evictions}
+
+    def _entries(self):
+        """(last use,path,size) of the entries"""
+        try:
+            subdirs = os.listdir(self.directory)
+        except OSError:
+            return
+        for d in subdirs:
+            try:
+                with os.scandir(os.path.join(self.directory,d)) as it:
+                    for e in it:
+                        if not e.name.endswith('.tmp'):
+                            try:
+                                st = e.stat()
+                            except FileNotFoundError:
+                                continue # removed meanwhile
+                            yield (st.st_mtime,e.path,st.st_size)
+            except OSError:
+                continue
+
+    def _remove(self,path) -> bool:
+        try:
+            os.remove(path)
+            return True
+        except OSError:
+            return False
@@ -0,0 +1,340 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Compact, versioned binary format of parse results.
+
+A file is the magic b'CNLP' and the format version (2 bytes), then
+records, one per value written (such as the acc of a parse).
+A value is made of None, bools, ints, floats, strings, lists, tuples,
+dicts and tokens (lexer.Token, DerivedToken, AttrToken, or ply's
+LexToken).  Token spans are stored as lists.
+
+Strings, token types included, go into a string table shared by the
+file: each record starts with the strings it adds to the table, and
+refers to strings by their index.  The value is stored as columns of
+integers, each of the least width that holds it (1, 2, 4 or 8 bytes):
+  the structure: a tag for each node, then its operands,
+  and for the tokens, in order: type, value, lineno, lexpos and raw
+  value (0 if it is the value, else its index + 1).
+lineno and lexpos are offsets from the least of the record, so that
+the spans of a statement take a byte or two.  A token met again in a
+record is a REF to it, so that sharing, as of the base of derived
+tokens, is kept.  An AttrToken is an ATTR node with the number of its
+extra attributes, its token, then the attribute names and values
+(format version 2; version 1 files are read as well).
+
+A record is
+    header: new strings, bytes of the strings, structure integers,
+            tokens, least lineno and lexpos, and the column widths
+    the byte lengths of the new strings (4 bytes each)
+    the new strings, utf-8
+    the columns
+all little endian.  Writer writes records as they come; Reader reads
+them lazily, decoding a record only when it is asked for.
+"""
+
+import sys
+import os
+import io
+import mmap
+import struct
+from array import array
+import lexer
+
+MAGIC = b'CNLP'
+FORMAT_VERSION = 2
+
+_head = struct.Struct('<4sH')
+_record = struct.Struct('<IIIIQQ6B')
+
+(NONE,FALSE,TRUE,INT,NEGINT,FLOAT,BIGINT,STR,LIST,TUPLE,DICT,TOKEN,DERIVED,REF,ATTR) = range(15)
+
+# array type codes of the widths of integers
+_typecodes = ['B','H','I','Q']
+
+def _width(col) -> int:
+    n = max(col,default=0)
+    for (w,limit) in enumerate([1 << 8,1 << 16,1 << 32,1 << 64]):
+        if n < limit:
+            return w
+    raise ValueError('integer out of range')
+
+class FormatError(ValueError):
+    pass
+
+class Writer:
+    """Writes values to a binary file fp, a record each"""
+
+    def __init__(self,fp):
+        self.fp = fp
+        self.strings = {}
+        self.records = 0
+        fp.write(_head.pack(MAGIC,FORMAT_VERSION))
+
+    def write(self,value):
+        """write value as a record"""
+        index = self.strings
+        new = []
+        def string(s):
+            i = index.get(s)
+            if i is None:
+                i = index[s] = len(index)
+                new.append(s)
+            return i
+        out = []
+        toks = []
+        memo = {}
+        def walk(x):
+            cls = x.__class__
+            if cls is lexer.Token or cls is lexer.DerivedToken or hasattr(x,'lexpos'):
+                i = memo.get(id(x))
+                if i is not None:
+                    out.extend((REF,i))
+                    return
+                if cls is lexer.DerivedToken:
+                    out.extend((DERIVED,string(x.type),string(x.value)))
+                    walk(x.base)
+                    memo[id(x)] = len(memo)
+                elif cls is lexer.AttrToken and x.__dict__:
+                    out.extend((ATTR,len(x.__dict__),TOKEN))
+                    toks.append(x)
+                    memo[id(x)] = len(memo)
+                    for (k,v) in x.__dict__.items():
+                        walk(k)
+                        walk(v)
+                else:
+                    out.append(TOKEN)
+                    toks.append(x)
+                    memo[id(x)] = len(memo)
+            elif cls is list or cls is tuple or cls is lexer.TokenSpan:
+                out.extend((TUPLE if cls is tuple else LIST,len(x)))
+                for y in x:
+                    walk(y)
+            elif cls is str:
+                out.extend((STR,string(x)))
+            elif x is None:
+                out.append(NONE)
+            elif cls is bool:
+                out.append(TRUE if x else FALSE)
+            elif cls is int:
+                if -(1 << 64) < x < (1 << 64):
+                    out.extend((INT,x) if x >= 0 else (NEGINT,-x))
+                else:
+                    out.extend((BIGINT,string(str(x))))
+            elif cls is float:
+                out.extend((FLOAT,string(repr(x))))
+            elif cls is dict:
+                out.extend((DICT,len(x)))
+                for (k,v) in x.items():
+                    walk(k)
+                    walk(v)
+            elif isinstance(x,tuple):
+                walk(tuple(x)) # namedtuples
+            else:
+                raise TypeError(f'cannot serialize {cls.__name__}')
+        walk(value)
+        linenos = [t.lineno for t in toks]
+        lexposes = [t.lexpos for t in toks]
+        line0 = min(linenos,default=0)
+        pos0 = min(lexposes,default=0)
+        cols = [out,
+                [string(t.type) for t in toks],
+                [string(t.value) for t in toks],
+                [n - line0 for n in linenos],
+                [n - pos0 for n in lexposes],
+                [0 if r is v or r == v else string(r) + 1
+                 for (r,v) in ((getattr(t,'rawvalue',t.value),t.value) for t in toks)]]
+        widths = [_width(col) for col in cols]
+        data = [s.encode('utf-8') for s in new]
+        arrays = [array('I',map(len,data))] + [array(_typecodes[w],col)
+                                               for (w,col) in zip(widths,cols)]
+        if sys.byteorder == 'big':
+            for a in arrays:
+                a.byteswap()
+        blob = b''.join(data)
+        write = self.fp.write
+        write(_record.pack(len(new),len(blob),len(out),len(toks),line0,pos0,*widths))
+        write(arrays[0].tobytes())
+        write(blob)
+        for a in arrays[1:]:
+            write(a.tobytes())
+        self.records += 1
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self,*exc):
+        self.fp.flush()
+
+class Reader:
+    """Lazy reader of the records of a file, given as a path,
+    a binary file or bytes.  A record is decoded when asked for,
+    by index or in turn."""
+
+    def __init__(self,source):
+        self._file = self._mmap = None
+        if isinstance(source,(bytes,bytearray,memoryview)):
+            data = source
+        else:
+            fp = open(source,'rb') if isinstance(source,(str,os.PathLike)) else source
+            if fp is not source:
+                self._file = fp
+            try:
+                data = self._mmap = mmap.mmap(fp.fileno(),0,access=mmap.ACCESS_READ)
+            except (OSError,ValueError):
+                data = fp.read() # empty, or not a real file
+        self.data = memoryview(data)
+        if len(self.data) < _head.size or _head.unpack_from(self.data)[0] != MAGIC:
+            raise FormatError('not a parse results file')
+        version = _head.unpack_from(self.data)[1]
+        if not(1 <= version <= FORMAT_VERSION):
+            raise FormatError(f'format version {version}, expected {FORMAT_VERSION}')
+        self.strings = []
+        self.records = [] # (header,offset of the columns) of the records scanned
+        self.pos = _head.size # of the next record to scan
+
+    def _scan(self,i) -> bool:
+        """Scan the records up to record i, reading their strings.
+        Returns whether there is a record i."""
+        data = self.data
+        while len(self.records) <= i and self.pos < len(data):
+            if self.pos + _record.size > len(data):
+                raise FormatError('truncated record')
+            header = _record.unpack_from(data,self.pos)
+            (ns,nb,n,ntoks) = header[:4]
+            p = self.pos + _record.size
+            lengths = array('I')
+            lengths.frombytes(data[p:p + lengths.itemsize*ns])
+            if sys.byteorder == 'big':
+                lengths.byteswap()
+            p += lengths.itemsize*ns
+            blob = bytes(data[p:p + nb])
+            k = 0
+            for m in lengths:
+                self.strings.append(sys.intern(blob[k:k + m].decode('utf-8')))
+                k += m
+            p += nb
+            self.records.append((header,p))
+            self.pos = p + sum(count * array(_typecodes[w]).itemsize
+                               for (count,w) in zip([n] + [ntoks]*5,header[6:]))
+            if self.pos > len(data):
+                raise FormatError('truncated record')
+        return i < len(self.records)
+
+    def __len__(self):
+        self._scan(sys.maxsize)
+        return len(self.records)
+
+    def __getitem__(self,i):
+        if i < 0:
+            i += len(self)
+        if i < 0 or not(self._scan(i)):
+            raise IndexError('record index out of range')
+        (header,p) = self.records[i]
+        (_,_,n,ntoks,line0,pos0) = header[:6]
+        cols = []
+        for (count,w) in zip([n] + [ntoks]*5,header[6:]):
+            a = array(_typecodes[w])
+            a.frombytes(self.data[p:p + count*a.itemsize])
+            if sys.byteorder == 'big':
+                a.byteswap()
+            p += count*a.itemsize
+            cols.append(a)
+        return _decode(cols,self.strings,line0,pos0)
+
+    def __iter__(self):
+        i = 0
+        while self._scan(i):
+            yield self[i]
+            i += 1
+
+    def close(self):
+        self.data.release()
+        if self._mmap is not None:
+            self._mmap.close()
+        if self._file is not None:
+            self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self,*exc):
+        self.close()
+
+def _decode(cols,strings,line0,pos0):
+    """the value of a record, from its columns"""
+    (structure,types,values,linenos,lexposes,raws) = cols
+    s = strings.__getitem__
+    values = list(map(s,values))
+    if any(raws):
+        raws = [v if r == 0 else strings[r - 1] for (v,r) in zip(values,raws)]
+    else:
+        raws = values
+    toks = iter(list(map(lexer.Token,map(s,types),values,
+                         [n + line0 for n in linenos],[n + pos0 for n in lexposes],raws)))
+    seen = []
+    nxt = iter(structure).__next__
+    def value():
+        tag = nxt()
+        if tag == TOKEN:
+            tok = next(toks)
+            seen.append(tok)
+            return tok
+        if tag == LIST:
+            return [value() for _ in range(nxt())]
+        if tag == STR:
+            return strings[nxt()]
+        if tag == TUPLE:
+            return tuple([value() for _ in range(nxt())])
+        if tag == NONE:
+            return None
+        if tag == REF:
+            return seen[nxt()]
+        if tag == ATTR:
+            n = nxt()
+            nxt() # TOKEN
+            tok = lexer.AttrToken.of_token(next(toks))
+            seen.append(tok)
+            for _ in range(n):
+                k = value()
+                setattr(tok,k,value())
+            return tok
+        if tag == DERIVED:
+            (ty,v) = (strings[nxt()],strings[nxt()])
+            tok = lexer.DerivedToken(value(),ty,v)
+            seen.append(tok)
+            return tok
+        if tag == INT:
+            return nxt()
+        if tag == NEGINT:
+            return -nxt()
+        if tag == TRUE or tag == FALSE:
+            return tag == TRUE
+        if tag == DICT:
+            d = {}
+            for _ in range(nxt()):
+                k = value()
+                d[k] = value()
+            return d
+        if tag == FLOAT:
+            return float(strings[nxt()])
+        if tag == BIGINT:
+            return int(strings[nxt()])
+        raise FormatError(f'bad tag {tag}')
+    return value()
+
+def dump(values,fp) -> int:
+    """write each of values as a record to binary file fp;
+    returns the number of records"""
+    w = Writer(fp)
+    for v in values:
+        w.write(v)
+    return w.records
+
+def dumps(values) -> bytes:
+    fp = io.BytesIO()
+    dump(values,fp)
+    return fp.getvalue()
+
+def loads(data) -> list:
+    return list(Reader(data))
@@ -0,0 +1,295 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Parse server on a local Unix socket, keeping a warm parser.
+
+The server pays once for the imports, the lexer, lit_dict and the
+grammar, then answers requests.  Requests and responses are JSON
+objects, one per line.  The request
+    {"id": 1, "op": "parse", "text": "...", "split": false}
+gets the response
+    {"id": 1, "tokens": 12, "acc": [...], "error": null,
+     "batch": 3, "queued": 0.0004, "seconds": 0.002}
+with acc the parse of the text as a document (see batch.parse_document
+and jsonable), batch the number of requests parsed with it, queued the
+seconds it waited, and seconds the time of its parse.  A client may
+send requests without waiting for the responses, which come back
+as they are ready.  The other ops are "stats" and "shutdown".
+
+Requests are parsed by a single thread, in batches: the requests
+waiting when it is free, up to BATCH_MAX, with BATCH_WAIT seconds
+for more to come.  Identical requests of a batch are parsed once.
+
+usage: python parse_server.py serve [--socket path]
+       python parse_server.py [--socket path] [-s] [-q] [files or directories]
+The client parses the corpus of batch.py by default, and prints what it prints.  With no server running
+it parses in process.
+"""
+
+import sys
+import os
+import json
+import time
+import queue
+import socket
+import argparse
+import tempfile
+import threading
+import socketserver
+from concurrent.futures import Future, wait
+import lexer
+import parser_combinator as c
+import production_rules as p
+import batch
+
+SOCKET = os.environ.get('CNL_PARSE_SOCKET',
+                        os.path.join(tempfile.gettempdir(),f'cnl-parse-{os.getuid()}.sock'))
+BATCH_MAX = 64
+BATCH_WAIT = 0.002
+
+def jsonable(x):
+    """parse results as JSON values:
+    a token is [type,value,lineno,lexpos], followed by a dictionary of
+    its extra attributes for an AttrToken, and a tuple or span a list"""
+    if hasattr(x,'lexpos'):
+        if x.__class__ is lexer.AttrToken and x.__dict__:
+            return [x.type,x.value,x.lineno,x.lexpos,
+                    {k : jsonable(v) for (k,v) in x.__dict__.items()}]
+        return [x.type,x.value,x.lineno,x.lexpos]
+    if isinstance(x,(list,tuple,lexer.TokenSpan)):
+        return [jsonable(y) for y in x]
+    if x is None or isinstance(x,(str,int,float,bool)):
+        return x
+    return repr(x)
+
+def parse_text(text,split=False) -> dict:
+    """the response to a parse request, but for the timings"""
+    session = c.ParserSession()
+    toks = session.lex(text)
+    (acc,error) = batch.parse_document(toks,session,split)
+    return {'tokens' : len(toks),'acc' : jsonable(acc),'error' : error}
+
+def warm():
+    """build the lexer, lit_dict and the grammar of the statement parsers"""
+    for k in p.lit_dict:
+        p.lit_dict[k]
+    for split in [False,True]:
+        parse_text('Let x be a set. [exit] x',split)
+
+class Handler(socketserver.StreamRequestHandler):
+    """The requests of a connection"""
+
+    def handle(self):
+        lock = threading.Lock()
+        def send(response):
+            data = (json.dumps(response) + '\n').encode('utf-8')
+            with lock:
+                try:
+                    self.wfile.write(data)
+                except OSError:
+                    pass
+        pending = []
+        for line in self.rfile:
+            try:
+                req = json.loads(line)
+                op = req.get('op','parse')
+            except (ValueError,AttributeError):
+                send({'id' : None,'error' : 'bad request'})
+                continue
+            if op == 'parse':
+                fut = self.server.submit(req)
+                fut.add_done_callback(lambda f : send(f.result()))
+                pending.append(fut)
+            elif op == 'stats':
+                send(dict(self.server.stats(),id=req.get('id')))
+            elif op == 'shutdown':
+                send({'id' : req.get('id'),'error' : None})
+                threading.Thread(target=self.server.shutdown).start()
+            else:
+                send({'id' : req.get('id'),'error' : f'unknown op: {op}'})
+        wait(pending)
+
+class ParseServer(socketserver.ThreadingMixIn,socketserver.UnixStreamServer):
+    """Server of parse requests on the Unix socket path"""
+    daemon_threads = True
+
+    def __init__(self,path=SOCKET):
+        warm()
+        if os.path.exists(path):
+            try:
+                with socket.socket(socket.AF_UNIX) as s:
+                    s.connect(path)
+                raise OSError(f'a server is running on {path}')
+            except ConnectionRefusedError:
+                os.remove(path)
+        super().__init__(path,Handler)
+        self.path = path
+        self.queue = queue.Queue()
+        self.requests = 0
+        self.batches = 0
+        self.busy = 0.0
+        self.started = time.perf_counter()
+        self.parser = threading.Thread(target=self._parse_loop,daemon=True)
+        self.parser.start()
+
+    def submit(self,req) -> Future:
+        fut = Future()
+        self.queue.put((req,fut,time.perf_counter()))
+        return fut
+
+    def _parse_loop(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            items = [item]
+            deadline = time.perf_counter() + BATCH_WAIT
+            while len(items) < BATCH_MAX:
+                try:
+                    item = self.queue.get(timeout=max(deadline - time.perf_counter(),0))
+                except queue.Empty:
+                    break
+                if item is None:
+                    self._run(items)
+                    return
+                items.append(item)
+            self._run(items)
+
+    def _run(self,items):
+        """parse a batch, identical requests once"""
+        t = time.perf_counter()
+        done = {}
+        responses = []
+        for (req,_,t_in) in items:
+            key = (req.get('text',''),bool(req.get('split')))
+            if key not in done:
+                t0 = time.perf_counter()
+                try:
+                    r = parse_text(*key)
+                except Exception as e:
+                    r = {'tokens' : 0,'acc' : None,'error' : f'server error: {e!r}'}
+                done[key] = (r,time.perf_counter() - t0)
+            (r,secs) = done[key]
+            responses.append(dict(r,id=req.get('id'),batch=len(items),
+                                  queued=t - t_in,seconds=secs))
+        self.requests += len(items)
+        self.batches += 1
+        self.busy += time.perf_counter() - t
+        for ((_,fut,_),response) in zip(items,responses):
+            fut.set_result(response)
+
+    def stats(self):
+        """Counters as a dictionary"""
+        return {'requests' : self.requests,
+                'batches' : self.batches,
+                'busy' : self.busy,
+                'uptime' : time.perf_counter() - self.started}
+
+    def start(self):
+        """serve in a background thread"""
+        threading.Thread(target=self.serve_forever,daemon=True).start()
+        return self
+
+    def server_close(self):
+        super().server_close()
+        self.queue.put(None)
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
+
+class ParseClient:
+    """Connection to a parse server"""
+
+    def __init__(self,path=SOCKET):
+        self.sock = socket.socket(socket.AF_UNIX)
+        self.sock.connect(path)
+        self.rfile = self.sock.makefile('rb')
+        self.next_id = 0
+
+    def request(self,reqs) -> list:
+        """send requests, and return their responses in order"""
+        ids = []
+        data = []
+        for req in reqs:
+            self.next_id += 1
+            ids.append(self.next_id)
+            data.append(json.dumps(dict(req,id=self.next_id)) + '\n')
+        self.sock.sendall(''.join(data).encode('utf-8'))
+        got = {}
+        while len(got) < len(ids):
+            line = self.rfile.readline()
+            if not line:
+                raise ConnectionError('parse server closed the connection')
+            r = json.loads(line)
+            got[r['id']] = r
+        return [got[i] for i in ids]
+
+    def parse_many(self,texts,split=False) -> list:
+        return self.request([{'op' : 'parse','text' : t,'split' : split} for t in texts])
+
+    def parse(self,text,split=False) -> dict:
+        return self.parse_many([text],split)[0]
+
+    def stats(self) -> dict:
+        return self.request([{'op' : 'stats'}])[0]
+
+    def shutdown(self):
+        self.request([{'op' : 'shutdown'}])
+
+    def close(self):
+        self.rfile.close()
+        self.sock.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self,*exc):
+        self.close()
+
+def parse_texts(texts,split=False,path=SOCKET) -> list:
+    """Responses to parse requests for texts, from the server on path,
+    or parsed in process when there is none."""
+    try:
+        with ParseClient(path) as client:
+            return client.parse_many(texts,split)
+    except (FileNotFoundError,ConnectionRefusedError):
+        rs = []
+        for t in texts:
+            t0 = time.perf_counter()
+            r = parse_text(t,split)
+            rs.append(dict(r,batch=1,queued=0.0,seconds=time.perf_counter() - t0))
+        return rs
+
+def main(argv):
+    ap = argparse.ArgumentParser(description='Parse server, and its client.')
+    ap.add_argument('paths',nargs='*',default=batch.default_corpus,
+                    help="files or directories to parse, or 'serve'")
+    ap.add_argument('--socket',default=SOCKET,help=f'socket path (default {SOCKET})')
+    ap.add_argument('-s','--split',action='store_true',
+                    help='parse statement by statement')
+    ap.add_argument('-q','--quiet',action='store_true',
+                    help='print the report only')
+    args = ap.parse_args(argv[1:])
+    if args.paths == ['serve']:
+        with ParseServer(args.socket) as server:
+            print(f'serving on {args.socket}')
+            server.serve_forever()
+        return 0
+    stats = batch.Throughput()
+    files = list(batch.corpus_files(args.paths))
+    texts = []
+    for f in files:
+        with open(f,encoding='utf-8') as fp:
+            texts.append(fp.read())
+    for (f,r) in zip(files,parse_texts(texts,args.split,args.socket)):
+        stats.add(batch.DocResult(f,batch.file_size(f),r['tokens'],r['acc'],r['error'],
+                                  r['seconds'],None))
+        if not(args.quiet):
+            status = r['error'] or f"{len(r['acc'])} statements"
+            print(f"{f}: {r['tokens']} tokens, {status}")
+    print(stats.report())
+    return 1 if stats.errors else 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
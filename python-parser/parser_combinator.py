@@ -15,12 +15,22 @@ import lib
 import lexer
 import word_lists
 import copy
-from collections import namedtuple
+import bisect
+import contextvars
+import functools
+import heapq
+import threading
+import time
+import weakref
+from collections import namedtuple, OrderedDict
 
 
 def copy_token(tok,attr):
-    """make a new token by addding attributes 'attr' to tok"""
-    tcopy = copy.copy(tok)
+    """make a new token by addding attributes 'attr' to tok.
+    A new type or value gives a light view of tok (see lexer.derive)."""
+    if set(attr) <= {'type','value'}:
+        return lexer.derive(tok,attr.get('type',tok.type),attr.get('value',tok.value))
+    tcopy = lexer.AttrToken.of_token(tok)
     for v in attr:
         tcopy.__setattr__(v,attr[v])
     return tcopy 
@@ -39,11 +49,7 @@ def mk_token(attr={'type':'INTEGER','value':'1'}):
 
 def init_mk_token():
     """Call this once to initialize mk_token."""
-    lexer.tokenizer.input('1')
-    mk_token._tok = [tok for tok in lexer.tokenizer][0]
-    mk_token._tok.__setattr__('lineno',0)
-    mk_token._tok.__setattr__('lexpos',0)
-    mk_token._tok.__setattr__('lexer',None)
+    mk_token._tok = lexer.Token('INTEGER','1',0,0)
     pass
 
 init_mk_token()
@@ -58,11 +64,103 @@ init_mk_token()
 
     
 
+class History:
+    """Persistent history of annotations [label,start,stop].
+    
+    A cons-list, newest entry first, so that pushing shares the
+    older entries instead of copying them.  Each node keeps the
+    min of the positive starts and max of the positive stops 
+    over the entries it reaches, so range_history is O(1).
+    Iteration runs oldest first, as for the lists it replaces.
+    Entries must not be mutated once pushed.
+    """
+    __slots__ = ('entry','parent','length','mn','mx')
+    
+    def __init__(self,entry=None,parent=None):
+        self.entry = entry
+        self.parent = parent
+        if parent is None:
+            self.length, self.mn, self.mx = 0, None, None
+            return
+        self.length = parent.length + 1
+        (_,i,j) = entry
+        mn, mx = parent.mn, parent.mx
+        self.mn = mn if i <= 0 or (mn is not None and mn <= i) else i
+        self.mx = mx if j <= 0 or (mx is not None and mx >= j) else j
+        
+    def push(self,entry):
+        """history with entry added"""
+        return History(entry,self)
+    
+    def extend(self,entries):
+        """history with entries added in order"""
+        h = self
+        for e in entries:
+            h = History(e,h)
+        return h
+    
+    def drop(self,n):
+        """history with the newest n entries removed"""
+        if n >= self.length:
+            return History.empty
+        h = self
+        for _ in range(n):
+            h = h.parent
+        return h
+    
+    def delta(self,h1):
+        """Entries that h1 adds on top of self, oldest first,
+        or None if h1 does not extend self."""
+        n = h1.length - self.length
+        if n < 0:
+            return None
+        es = []
+        for _ in range(n):
+            es.append(h1.entry)
+            h1 = h1.parent
+        if h1 is not self:
+            return None
+        es.reverse()
+        return es
+    
+    def __len__(self):
+        return self.length
+    
+    def __iter__(self):
+        es = []
+        h = self
+        while h.parent is not None:
+            es.append(h.entry)
+            h = h.parent
+        return reversed(es)
+    
+    def __getitem__(self,i):
+        if i < 0:
+            i += self.length
+        if not(0 <= i < self.length):
+            raise IndexError('history index out of range')
+        return self.drop(self.length - 1 - i).entry
+    
+    def __eq__(self,other):
+        if self is other:
+            return True
+        if isinstance(other,(History,list)):
+            return len(self) == len(other) and list(self) == list(other)
+        return NotImplemented
+    
+    __hash__ = None
+    
+    def __repr__(self):
+        return repr(list(self))
+
+History.empty = History()
+
 # An item is a token embedded at a particular position of the tuple of tokens.
 # The stream and individual tokens remain immutable.  
 # pos changes.
 # acc is the accumulator holding the parsed data, with stream range start:stop
 # history is for error-handling, positions refer to positions of toks in stream.
+# history is a persistent History, shared between items.
 Item = namedtuple('Item','stream pos acc history')
 
 def init_item(s) -> Item:
@@ -70,7 +168,7 @@ def init_item(s) -> Item:
 #   # a token used for cloning
     if len(s) > 0:
         init_item.tok = s[0]
-    return Item(pos=0,stream=s,acc=None,history=[])
+    return Item(pos=0,stream=s,acc=None,history=History.empty)
 
 #v = init_item([3,4,5])
 #print(init_item.tok)
@@ -82,7 +180,7 @@ def next_item(item:Item) -> Item:
         raise StopIteration
     return Item(pos = item.pos+1,stream = item.stream,
                 acc = item.stream[item.pos],
-                history = item.history+ [['next-item',item.pos,item.pos +1]])
+                history = item.history.push(['next-item',item.pos,item.pos +1]))
     #it = copy.copy(item)
     #it.pos = it.pos + 1
     #it.acc = item.stream[item.pos]
@@ -106,14 +204,24 @@ def add_history(item:Item,h,drop=0) -> Item:
     #debug
     h1 = item.history
     if drop > 0:
-        h1 = h1[:-drop]
+        h1 = h1.drop(drop)
     return Item(pos = item.pos,stream = item.stream,
             acc = item.acc,
-            history = h1+h)
+            history = h1.extend(h))
+
+def history_delta(h,h1):
+    """Return the entries that h1 adds on top of h, 
+    or None if h1 does not extend h."""
+    return h.delta(h1)
 
-def range_history(name:str,hs):
-    mn = min((i for (_,i,_) in hs if i > 0),default=0)
-    mx = max((i for (_,_,i) in hs if i > 0),default=mn)
+def history_extend(h,delta):
+    """Extend history h by the entries of delta"""
+    return h.extend(delta)
+
+def range_history(name:str,hs:History):
+    """Annotation spanning the positive positions in hs"""
+    mn = 0 if hs.mn is None else hs.mn
+    mx = mn if hs.mx is None else hs.mx
     #print(f'min,max=({mn},{mx})')
     return [name,mn,mx]
 
@@ -129,6 +237,43 @@ class ParseNoCatch(BaseException):
     def __init__(self,msg=''):
         self.msg = msg
         
+class Failure:
+    """Failed result returned by Parse.step, in place of an exception.
+    item is the item that ParseError would carry.
+    If msg is not None, the failure is not caught by other parsers,
+    as for ParseNoCatch."""
+    __slots__ = ('item','msg')
+    
+    def __init__(self,item,msg=None):
+        self.item = item
+        self.msg = msg
+        
+    def exception(self):
+        """the exception that process raises for this failure"""
+        if self.msg is None:
+            return ParseError(self.item)
+        return ParseNoCatch(self.msg)
+    
+def locate_history(item,smap):
+    """History entries of item, with token positions as 
+    (line,column) through source map smap (see lexer.SourceMap):
+    a list of (label,start,end)."""
+    stream = item.stream
+    return [(e[0],smap.stream_location(stream,e[1]),smap.stream_location(stream,e[2]))
+            for e in item.history]
+    
+def catching(f):
+    """Convert f:Item->Item raising ParseError or ParseNoCatch 
+    into a step function returning Failure."""
+    def step(item):
+        try:
+            return f(item)
+        except ParseError as pe:
+            return Failure(pe.args[0])
+        except ParseNoCatch as pn:
+            return Failure(None,pn.msg)
+    return step
+        
 #def can_eval(f,x):
 #    try:
 #        f(x)
@@ -141,6 +286,192 @@ class ParseNoCatch(BaseException):
 #        raise ParseError
 #    return b
 
+# packrat memoization
+
+class Packrat:
+    """Memo table for packrat parsing.
+    
+    Results of productions are stored under (production,stream,pos),
+    success or failure.  Histories are stored relative to the input
+    item, so a hit can be replayed on an item with a different history.
+    The table holds at most capacity entries, evicting least recently used.
+    Off by default; turn on with enable().
+    """
+    
+    def __init__(self,capacity=100000):
+        self.enabled = False
+        self.capacity = capacity
+        self.table = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        
+    def enable(self,capacity=None):
+        """Turn on packrat mode, optionally resetting the entry cap"""
+        if capacity is not None:
+            self.capacity = capacity
+            self._trim()
+        self.enabled = True
+        Parse.rewire()
+        
+    def disable(self):
+        """Turn off packrat mode and drop all entries"""
+        self.enabled = False
+        self.clear()
+        Parse.rewire()
+        
+    def clear(self):
+        """Drop all entries and reset the counters"""
+        self.table.clear()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        
+    def stats(self):
+        """Counters as a dictionary"""
+        return {'entries' : len(self.table),
+                'capacity' : self.capacity,
+                'hits' : self.hits,
+                'misses' : self.misses,
+                'evictions' : self.evictions}
+    
+    def lookup(self,key,prs,stream):
+        """Return the entry for key, or None.
+        The entry holds references to prs and stream, so ids are not reused."""
+        entry = self.table.get(key)
+        if entry is None or entry[0] is not prs or entry[1] is not stream:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.table.move_to_end(key)
+        return entry
+    
+    def store(self,key,prs,item,item1,failed):
+        """Record result item1 (or failure item) of prs on item."""
+        delta = history_delta(item.history,item1.history)
+        if delta is None:
+            return
+        same_acc = item1.acc is item.acc
+        if same_acc and not(failed) and item1.pos == item.pos:
+            return # output depends on the input acc
+        self.table[key] = (prs,item.stream,failed,item1.pos,
+                           None if same_acc else item1.acc,same_acc,delta)
+        self._trim()
+        
+    def _trim(self):
+        """Evict least recently used entries down to capacity"""
+        while len(self.table) > self.capacity:
+            self.table.popitem(last=False)
+            self.evictions += 1
+
+    def replay(self,entry,item):
+        """Rebuild the stored result on item, a Failure if stored as one."""
+        (_,_,failed,pos,acc,same_acc,delta) = entry
+        item1 = Item(pos=pos,stream=item.stream,
+                     acc = item.acc if same_acc else acc,
+                     history = history_extend(item.history,delta))
+        if failed:
+            return Failure(item1)
+        return item1
+
+packrat = Packrat()
+
+# profiling
+
+class Profiler:
+    """Profile of the labelled parsers (productions, see production).
+
+    For each label: calls, successes, failures, tokens consumed by the
+    successes, tokens backtracked over by the failures (up to the
+    position each failed at), total time, and self time, which leaves 
+    out the time of the labelled parsers called.  The total time of a
+    recursive call is counted once, in the outermost call.
+    Off by default, and then free; turn on with enable().
+    Only the closure engine is profiled, not vm programs.
+    """
+    
+    columns = ('calls','successes','failures','tokens','backtracked','total','self')
+    
+    def __init__(self):
+        self.enabled = False
+        self.table = {}
+        self.local = threading.local()
+        
+    def enable(self):
+        """Turn on profiling"""
+        self.enabled = True
+        Parse.rewire()
+        
+    def disable(self):
+        """Turn off profiling, keeping the counts"""
+        self.enabled = False
+        Parse.rewire()
+        
+    def clear(self):
+        """Reset the counts"""
+        self.table.clear()
+        
+    def wrap(self,label,step):
+        """step, counting in the row of label"""
+        local = self.local
+        clock = time.perf_counter
+        row = self.table.setdefault(label,[0,0,0,0,0,0.0,0.0])
+        def f(item):
+            try:
+                children = local.children # time of the labelled callees, per active call
+                active = local.active
+            except AttributeError:
+                children = local.children = []
+                active = local.active = {}
+            depth = active.get(label,0)
+            active[label] = depth + 1
+            children.append(0.0)
+            t = clock()
+            try:
+                r = step(item)
+            except BaseException:
+                r = None
+                raise
+            finally:
+                dt = clock() - t
+                active[label] = depth
+                row[6] += dt - children.pop()
+                if children:
+                    children[-1] += dt
+                if depth == 0:
+                    row[5] += dt
+                row[0] += 1
+                if r is None or r.__class__ is Failure:
+                    row[2] += 1
+                    if r is not None and r.item is not None: # not a ParseNoCatch
+                        row[4] += r.item.pos - item.pos
+                else:
+                    row[1] += 1
+                    row[3] += r.pos - item.pos
+            return r
+        return f
+    
+    def stats(self):
+        """Rows of the profile, as dictionaries by label"""
+        return {label : dict(zip(Profiler.columns,row)) for (label,row) in self.table.items()}
+        
+    def report(self,sort='self',limit=40) -> str:
+        """The profile as a table, sorted on column sort, 
+        with limit rows at most (None for all)"""
+        k = Profiler.columns.index(sort)
+        rows = sorted(((label,row) for (label,row) in self.table.items() if row[0] > 0),
+                      key=lambda lr : -lr[1][k])
+        total = sum(row[6] for (_,row) in rows) or 1.0
+        width = max([len('production')] + [len(label) for (label,_) in rows[:limit]])
+        lines = [f'{"production":<{width}} {"calls":>8} {"succ":>8} {"fail":>8} '
+                 f'{"tokens":>8} {"backtr":>8} {"total s":>9} {"self s":>9} {"self%":>6}']
+        for (label,(calls,succ,fail,toks,back,tot,slf)) in rows[:limit]:
+            lines.append(f'{label:<{width}} {calls:>8} {succ:>8} {fail:>8} {toks:>8} '
+                         f'{back:>8} {tot:>9.4f} {slf:>9.4f} {100*slf/total:>6.1f}')
+        return '\n'.join(lines)
+        
+profiler = Profiler()
+
 #not yet used...
 #class ParseCell:
 #    """base class for parsed data"""
@@ -167,13 +498,86 @@ class ParseNoCatch(BaseException):
 class Parse:
     """base class for parsers.
     f:Item->Item processes one or more tokens from the item stream.
+    
+    Internally parsers run through step:Item->Item|Failure, 
+    which returns failures instead of raising them, so that 
+    backtracking does not pay for exceptions.  process raises
+    ParseError or ParseNoCatch from the failure, for callers.
     """
-    def __init__(self,f):
-        """r:Item->Item, repr:str"""
-        self.process = f
+    _instances = weakref.WeakSet()
+    
+    def __init__(self,f=None,children=(),memo=True,kind=None,first=None,step=None,arg=None):
+        """f:Item->Item, raising ParseError on failure, 
+        or step:Item->Item|Failure.
+        children are the parsers that f calls.
+        memo=False excludes the parser from packrat memoization.
+        kind names the combinator and arg its non-parser argument, 
+        for code that needs to recognize it (such as the vm compiler).
+        first is the set of token keys (see token_keys) the parser can 
+        start with, or None if unknown.  A parser with a first set
+        fails without progress on a token with no key in the set."""
+        self._f = f
+        self._step = step if step is not None else catching(f)
+        self.children = children
+        self.kind = kind
+        self.arg = arg
+        self.first = first
+        self.yields = None # 'token' or 'word' for single token parsers
+        self.label = None # name in profiles, set by production
+        self.pure = all(p.pure for p in children)
+        self.memo = memo and self.pure
+        self._wire()
+        Parse._instances.add(self)
         #self.repr = repr 
  #       self.err = errmsg
         
+    def _wire(self):
+        """Set step and process according to the active engine modes"""
+        memo = packrat.enabled and self.memo
+        self.step = self._memo_step if memo else self._step
+        profiled = profiler.enabled and self.label is not None
+        if profiled:
+            self.step = profiler.wrap(self.label,self.step)
+        if self._f is not None and not(memo) and not(profiled):
+            self.process = self._f
+        else:
+            self.process = self._raise_process
+            
+    def rewire():
+        """Reset process on all live parsers after a mode change"""
+        for p in list(Parse._instances):
+            p._wire()
+            
+    def _raise_process(self,item):
+        """process through step, raising on failure"""
+        r = self.step(item)
+        if r.__class__ is Failure:
+            raise r.exception()
+        return r
+            
+    def _memo_step(self,item):
+        """step through the packrat table"""
+        key = (id(self),id(item.stream),item.pos)
+        entry = packrat.lookup(key,self,item.stream)
+        if entry is not None:
+            return packrat.replay(entry,item)
+        r = self._step(item)
+        if r.__class__ is Failure:
+            if r.msg is None:
+                packrat.store(key,self,item,r.item,True)
+        else:
+            packrat.store(key,self,item,r,False)
+        return r
+    
+    def nomemo(self):
+        """Exclude this parser from packrat memoization. 
+        Use for parsers with side effects.
+        Parsers later built on top of this one are excluded too."""
+        self.pure = False
+        self.memo = False
+        self._wire()
+        return self
+        
 #    def __repr__(self):
 #        """Description of production rule"""
 #        return f'Parse({self.repr})'
@@ -183,98 +587,204 @@ class Parse:
         return self
         
     def next_token(): # constructor for next token
-        return Parse(next_item)
+        pr = Parse(next_item,step=next_item,kind='next_token')
+        pr.yields = 'token'
+        return pr
     
     def finished():
         """fails if tokens remain in stream, otherwise do nothing"""
         def f(item):
             if item.pos < len(item.stream):
-                vs = [i.value for i in item.stream[item.pos:len(item.stream)]].join(' ')
+                vs = ' '.join(i.value for i in item.stream[item.pos:len(item.stream)])
                 item1 = add_history(item, [['excess tokens:'+ vs,item.pos,item.pos]])
-                raise ParseError(item1)
+                return Failure(item1)
             return item
-        return Parse(f)
+        return Parse(step=f,kind='finished')
     
     def probe(self):
         """run parser but then undo"""
         def f(item):
-            self.process(item)
+            r = self.step(item)
+            if r.__class__ is Failure:
+                return r
             return item
-        return Parse(f)
+        return Parse(step=f,children=[self],kind='probe',first=self.first)
     
     def reparse(self):
         """Run parser as a reparser on list of accumulated tokens.  
         If accumulated tokens == [], then do nothing.
         All tokens must be consumed.
         """
+        pr = self + Parse.finished()
         def f(item):
             acc = item.acc
             if len(acc) == 0:
                 return item
-            item1 = Item(acc,0,None,[])
-            item2 = (self + Parse.finished()).process(item1)
+            item1 = Item(acc,0,None,History.empty)
+            item2 = pr.step(item1)
+            if item2.__class__ is Failure:
+                return item2
             item3 = update(item2.acc,item)
             return item3
-        return Parse(f)
+        return Parse(step=f,children=[self],memo=False,kind='reparse')
     
     def reparse_list(self):
         """Run parser as reparser on each accumulated list entry.
         All tokens must be consumed."""
+        pr = self + Parse.finished()
         def f(item):
             acc = item.acc
-            its1 = [Item(a,0,None,[]) for a in acc]
-            acc2 = [(self + Parse.finished()).process(it).acc for it in its1]
+            acc2 = []
+            for a in acc:
+                item2 = pr.step(Item(a,0,None,History.empty))
+                if item2.__class__ is Failure:
+                    return item2
+                acc2.append(item2.acc)
             item3 = update(acc2,item)
             return item3
-        return Parse(f)
+        return Parse(step=f,children=[self],memo=False,kind='reparse_list')
     
     def expect(self,history_label):
         """Add history annotation for expectation in case of error"""
         def f(item):
-            try:    
-                return self.process(item)  
-            except ParseError as pe:
-                item1 = add_history(pe.args[0],[[f'expecting:{history_label}',item.pos,item.pos]])
-                raise ParseError(item1)
-        return Parse(f)
+            r = self.step(item)
+            if r.__class__ is Failure and r.msg is None:
+                item1 = add_history(r.item,[[f'expecting:{history_label}',item.pos,item.pos]])
+                return Failure(item1)
+            return r
+        return Parse(step=f,children=[self],kind='expect',arg=history_label,first=self.first)
     
     def history(self,h,drop=0):
         def f(item):
             return add_history(item,h,drop)
-        return Parse(f)
+        return Parse(step=f,children=[self],kind='history',arg=(h,drop))
     
     def clear_history(self):
         def f(item):
             return add_history(item,[],drop=len(item.history))
-        return Parse(f)
+        return Parse(step=f,children=[self],kind='clear_history')
         
     #def __call__(self,item):
     #    return self.process(item)
 
-    def __add__(self,other):
-        """combine two parsers in succession, returning pair of results."""
-        def f(item:Item):
-            item1 = self.process(item)
-            item2 = other.process(item1)
-            mh = range_history('add',item2.history)
-            return add_history(update((item1.acc,item2.acc),item2),[mh])
-        return Parse(f)
+    def _sequence(prs,nested):
+        """Run parsers in succession in a single loop.
+        Each parser after the first is followed by an 'add' history entry, 
+        as in the chain prs[0] + prs[1] + ... 
+        If nested, the output is left-nested pairs as built by that chain,
+        otherwise a flat tuple."""
+        def f(item):
+            if len(prs) == 0:
+                return update((),item)
+            item = prs[0].step(item)
+            if item.__class__ is Failure:
+                return item
+            acc = item.acc
+            accs = [acc]
+            for p in prs[1:]:
+                item = p.step(item)
+                if item.__class__ is Failure:
+                    return item
+                accs.append(item.acc)
+                acc = (acc,item.acc) if nested else item.acc
+                item = Item(pos = item.pos,stream = item.stream,acc = acc,
+                            history = item.history.push(range_history('add',item.history)))
+            if nested:
+                return item
+            return update(tuple(accs),item)
+        return f
+    
+    def _first_of_sequence(prs):
+        return prs[0].first if len(prs) > 0 else None
+    
+    def seq(prs):
+        """sequentially parse a list of parsers, returning a flat tuple of results.
+        The history is the same as for prs[0] + ... + prs[-1]."""
+        prs = list(prs)
+        return Parse(step=Parse._sequence(prs,False),children=prs,kind='seq',
+                     first=Parse._first_of_sequence(prs))
 
-    def __or__(self,other):
-        """try first parser then next. Lower precedence than +"""
+    def __add__(self,other):
+        """combine two parsers in succession, returning pair of results.
+        A left-nested chain a + b + c is collapsed into a single sequence
+        which still returns ((a,b),c)."""
+        if self.kind == 'add':
+            prs = self.children + [other]
+        else:
+            prs = [self,other]
+        return Parse(step=Parse._sequence(prs,True),children=prs,kind='add',
+                     first=Parse._first_of_sequence(prs))
+
+    def _dispatch(prs):
+        """Build a function giving the indices of the alternatives in prs 
+        that can start with a token, in order.
+        Returns None if no alternative has a known first set."""
+        always = tuple(i for i,p in enumerate(prs) if p.first is None)
+        if len(always) == len(prs):
+            return None
+        buckets = {}
+        for i,p in enumerate(prs):
+            for k in (p.first or ()):
+                buckets.setdefault(k,set()).add(i)
+        table = {k : tuple(sorted(b.union(always))) for (k,b) in buckets.items()}
+        def candidates(tok):
+            hits = [table[k] for k in token_keys(tok) if k in table]
+            if len(hits) == 0:
+                return always
+            if len(hits) == 1:
+                return hits[0]
+            return tuple(sorted(set().union(*hits)))
+        return candidates
+    
+    def _alternatives(prs,fail_last):
+        """Try parsers in order, returning the first success.
+        On failure return the most progressed failure, 
+        ties going to the later parser. 
+        If fail_last, the input item counts as a last failure, as in Parse.first.
+        Alternatives that cannot start with the next token are skipped.
+        Their failures would be at the input position; when that could 
+        decide the outcome, they are run after all."""
+        candidates = Parse._dispatch(prs)
         def f(item):
-            try:
-                return self.process(item)
-            except ParseError as pe1:
-                try:
-                    return other.process(item)
-                except ParseError as pe2:
-                    item1 = pe1.args[0]
-                    item2 = pe2.args[0]
-                    if item1.pos > item2.pos: #raise the most progressed
-                        raise ParseError(item1)
-                    raise ParseError(item2)
-        return Parse(f)
+            idxs = None
+            if candidates is not None and item.pos < len(item.stream):
+                idxs = candidates(item.stream[item.pos])
+            errs = []
+            for i in (range(len(prs)) if idxs is None else idxs):
+                r = prs[i].step(item)
+                if r.__class__ is not Failure or r.msg is not None:
+                    return r
+                errs.append((i,r.item))
+            if fail_last:
+                errs.append((len(prs),item))
+            elif idxs is not None and len(idxs) < len(prs):
+                if len(errs) == 0 or max(e.pos for (_,e) in errs) <= item.pos:
+                    for i in set(range(len(prs))).difference(idxs):
+                        r = prs[i].step(item)
+                        if r.__class__ is Failure and r.msg is None:
+                            errs.append((i,r.item))
+                    errs.sort(key = lambda ie : ie[0])
+            err = errs[0][1]
+            for (_,e) in errs[1:]:
+                if e.pos >= err.pos: #fail with the most progressed
+                    err = e
+            return Failure(err)
+        return f
+    
+    def _first_of_alternatives(prs):
+        if any(p.first is None for p in prs):
+            return None
+        return frozenset().union(*(p.first for p in prs))
+        
+    def __or__(self,other):
+        """try first parser then next. Lower precedence than +
+        A left-nested chain a | b | c is collapsed into a single alternation."""
+        if self.kind == 'or':
+            prs = self.children + [other]
+        else:
+            prs = [self,other]
+        return Parse(step=Parse._alternatives(prs,False),children=prs,kind='or',
+                     first=Parse._first_of_alternatives(prs))
     
 #    def compose(self,other): #was dependent plus
 #        """compose parsers"""
@@ -288,66 +798,108 @@ class Parse:
     def nocatch(self,msg): #was fix
         """No catch error if failure"""
         def f(item):
-            try:
-                return self.process(item)
-            except ParseError:
-                raise ParseNoCatch(msg)
-        return Parse(f)
+            r = self.step(item)
+            if r.__class__ is Failure and r.msg is None:
+                return Failure(r.item,msg)
+            return r
+        return Parse(step=f,children=[self],kind='nocatch',arg=msg)
     
     # was __rshift__ but Python gives it higher precedence than | +, which isn't helpful.
     def treat(self,treatment):
         """apply treatment to parser output."""
         def f(item):
-            item1 = self.process(item)
+            item1 = self.step(item)
+            if item1.__class__ is Failure:
+                return item1
             return update(treatment(item1.acc),item1)
-        return Parse(f)
+        return Parse(step=f,children=[self],kind='treat',arg=treatment,first=self.first)
+        
+    def _repeat(self,item,n,label,keep=True):
+        """Run self repeatedly in a loop, at least n times.
+        Returns accumulated list and final item, 
+        or None as the output if not keep. 
+        The history gets a single range entry labelled label."""
+        acc = [] if keep else None
+        count = 0
+        while count < n:
+            item = self.step(item)
+            if item.__class__ is Failure:
+                return item
+            if keep:
+                acc.append(item.acc)
+            count += 1
+        while True:
+            try:
+                item1 = self.step(item)
+            except StopIteration:
+                break
+            if item1.__class__ is Failure:
+                if item1.msg is not None:
+                    return item1
+                break
+            if keep:
+                acc.append(item1.acc)
+            count += 1
+            if item1.pos == item.pos: # no progress, stop
+                item = item1
+                break
+            item = item1
+        h = [label,item.pos,item.pos]
+        if count > 0 or n > 0:
+            h = range_history(label,item.history.push(h))
+        return add_history(update(acc,item),[h])
         
     def many(self):
         """parse zero or more times"""
-#        def augment_history(item,mh):
-#            (_,i) = item.history[-1][0].split(' ')
-#            return ('many '+(int(i)+1),mh[1],mh[2])
         def f(item):
-            try:
-                item1 = self.process(item)
-            except (ParseError, StopIteration):
-                return add_history(update([],item),[['many',item.pos,item.pos]])
-            item2 = self.many().process(item1) #this doesn't fail
-            mh = range_history('many',item2.history)
-            return add_history(update([item1.acc]+item2.acc,item2),[mh],drop=1)  
-        return Parse(f)
+            return self._repeat(item,0,'many')
+        return Parse(step=f,children=[self],kind='repeat',arg=0)
     
     def atleast(self,n):
         """parse at least n times"""
         def f(item):
-            if n < 1:
-                item1 = self.many().process(item)
-                h = item1.history[-1]
-                h[0]= 'plus'
-                return add_history(item1,[h],drop=1)
-            else:
-                item1 = (self + Parse.atleast(self,n-1)).treat(lib.prepend).process(item)
-                h = range_history('plus',item1.history)
-                return add_history(item1,[h],drop=2)
-        return Parse(f)
+            return self._repeat(item,n,'plus')
+        return Parse(step=f,children=[self],kind='repeat',arg=n,
+                     first=self.first if n > 0 else None)
     
     def plus(self):
         """parse at least once"""
         return self.atleast(1).set_repr('plus')
     
+    def skip(self,n=0):
+        """parse at least n times as many (n=0) or atleast, 
+        but discarding the outputs; the output is None.  
+        Use under span."""
+        label = 'many' if n == 0 else 'plus'
+        def f(item):
+            return self._repeat(item,n,label,keep=False)
+        return Parse(step=f,children=[self],kind='skip',arg=n,
+                     first=self.first if n > 0 else None)
+    
+    def span(self):
+        """replace output with the span of the tokens consumed,
+        a lexer.TokenSpan over the stream"""
+        def f(item):
+            item1 = self.step(item)
+            if item1.__class__ is Failure:
+                return item1
+            return update(lexer.TokenSpan(item.stream,item.pos,item1.pos),item1)
+        return Parse(step=f,children=[self],kind='span',first=self.first)
+    
     def possibly(self):
         """zero or one parses returned in a list"""
         def f(item):
-            try:    
-                item1 = self.process(item)
-                return update([item1.acc],item1)
-            except ParseError:
+            item1 = self.step(item)
+            if item1.__class__ is Failure:
+                if item1.msg is not None:
+                    return item1
                 return update([],item)
-        return Parse(f)
+            return update([item1.acc],item1)
+        return Parse(step=f,children=[self],kind='possibly')
     
     def identity(): #was nothing
         """Does no parsing, identity parser"""
-        return Parse(lambda item:item)
+        return Parse(step=lambda item:item,kind='identity')
     
     def nil(self):
         """replaces output with nil list"""
@@ -365,12 +917,11 @@ class Parse:
     def if_test(self,p): #was some
         """Next passes boolean test or fail"""
         def f(item):
-            item1 = self.process(item)
-            if p(item1.acc):
+            item1 = self.step(item)
+            if item1.__class__ is Failure or p(item1.acc):
                 return item1
-            else:
-                raise ParseError(item)
-        return Parse(f)
+            return Failure(item)
+        return Parse(step=f,children=[self],kind='if_test',arg=p,first=self.first)
     
 #    def if_test_treat(self,p): #was someX
 #        """Next passes test and evaluates, or fail"""
@@ -387,33 +938,40 @@ class Parse:
         """parse if next token has value v or fail"""
         def p(tok):
             return tok.value == v
-        return self.if_test(p).expect(v)
+        pr = self.if_test(p).expect(v)
+        if self.yields == 'token':
+            pr.first = frozenset([('value',v)])
+        elif self.yields == 'word':
+            pr.first = frozenset([('word',v)])
+        return pr
     
     def if_type(self,ts): 
         """parse if next type is in ts or fail"""
         def p(tok):
             return tok.type in ts
-        return self.if_test(p).expect('token in '+' '.join(ts))
+        pr = self.if_test(p).expect('token in '+' '.join(ts))
+        if self.yields == 'token' and not(isinstance(ts,str)):
+            pr.first = frozenset(('type',t) for t in ts)
+        return pr
  
     # class methods
     def all(prs):
         """sequentially parse a list of parsers and return list of results"""
         def f(item):
-            if len(prs) == 0:
-                return update([],item)
-            else:
-                item1 = prs[0].process(item)
-                item2 = Parse.all(prs[1:]).process(item1)
-                return update([item1.acc]+item2.acc,item2)
-        return Parse(f)
+            acc = []
+            for p in prs:
+                item = p.step(item)
+                if item.__class__ is Failure:
+                    return item
+                acc.append(item.acc)
+            return update(acc,item)
+        return Parse(step=f,children=prs,kind='all',first=Parse._first_of_sequence(prs))
     
     def first(prs): #was parse_some 
         """parse first in a list that does not fail"""
-        def f(item):
-            raise ParseError(item)
-        if len(prs) == 0:
-            return Parse(f)
-        return Parse.__or__(prs[0],Parse.first(prs[1:]))
+        prs = list(prs)
+        return Parse(step=Parse._alternatives(prs,True),children=prs,kind='first',
+                     first=Parse._first_of_alternatives(prs))
 #            else:
 #                
 #                try: 
@@ -422,6 +980,21 @@ class Parse:
 #                    return Parse.first(prs[1:]).process(item)
 #        return Parse(f)
     
+    def forward(name):
+        """Placeholder for a parser that is still being built.
+        It runs the parser given to resolve."""
+        def f(item):
+            return pr.target.step(item)
+        pr = Parse(step=f,memo=False,kind='forward')
+        pr.name = name
+        pr.target = None
+        return pr
+    
+    def resolve(self,target):
+        """Set the parser that a forward placeholder runs"""
+        self.target = target
+        self.children = [target]
+        
     def gen_first(prs_gen,args):
         """Repeat (lazy) parse generator until first non-failure.
         Yields of generator function prs_gen should be a parser.
@@ -434,21 +1007,20 @@ class Parse:
                 try:
                     prs = next(gen)
                     #print(f'{prs}--start on {item.stream[item.pos].value}')
-                    item1 = prs.process(item)
-                    del gen
-                    #print(f'{prs}--works')
-                    return item1
-                except ParseError as pe:
-                    #print(f'{prs}--fails')
-                    item_e = pe.args[0]
-                    if item_e.pos > item_max.pos:
-                        item_max = item_e
-                    pass
+                    item1 = prs.step(item)
                 except StopIteration:
                     #print(f'{prs}--stop')
                     del gen
-                    raise ParseError(item_max)
-        return Parse(f)
+                    return Failure(item_max)
+                if item1.__class__ is not Failure or item1.msg is not None:
+                    del gen
+                    #print(f'{prs}--works')
+                    return item1
+                #print(f'{prs}--fails')
+                item_e = item1.item
+                if item_e.pos > item_max.pos:
+                    item_max = item_e
+        return Parse(step=f,kind='gen_first',arg=(prs_gen,args))
     
 
     
@@ -456,22 +1028,141 @@ class Parse:
 
 
 
-# scoping 
-scope_current = {}
+# synonym handling uses a table per session, must be single words.
 
-# synonym handling uses a global dictionary, must be single words.
+class SynonymTable:
+    """Classes of synonymous words, as a union-find structure 
+    over small integer class ids, with union by size.  
+    Each word maps to its class id, and each class keeps its sorted 
+    members and its canonical form, the members joined by spaces.
+    Merging relabels the words of the smaller class, so finding 
+    the class, and so the canonical form, of a word is a dictionary 
+    lookup and a list index."""
+    
+    def __init__(self,words=()):
+        self.cls = {}     # word -> class id
+        self.members = [] # class id -> sorted words, [] once merged away
+        self.canon = []   # class id -> canonical form
+        self.key = ()     # canonical forms of the merged classes, sorted
+        for w in words:
+            self.add(w)
+            
+    def __contains__(self,word):
+        return word in self.cls
+    
+    def add(self,word) -> int:
+        """class id of word, adding it as a class of its own if new"""
+        i = self.cls.get(word)
+        if i is None:
+            i = len(self.members)
+            self.cls[word] = i
+            self.members.append([word])
+            self.canon.append(word)
+        return i
+    
+    def union(self,w1,w2) -> int:
+        """merge the classes of two words, returning the class id"""
+        i, j = self.add(w1), self.add(w2)
+        if i == j:
+            return i
+        if len(self.members[i]) < len(self.members[j]):
+            i, j = j, i
+        key = list(self.key)
+        for k in (i,j):
+            if len(self.members[k]) > 1:
+                del key[bisect.bisect_left(key,self.canon[k])]
+        for w in self.members[j]:
+            self.cls[w] = i
+        self.members[i] = list(heapq.merge(self.members[i],self.members[j]))
+        self.members[j] = []
+        self.canon[i] = ' '.join(self.members[i])
+        bisect.insort(key,self.canon[i])
+        self.key = tuple(key)
+        return i
+    
+    def canonical(self,word,default=None):
+        i = self.cls.get(word)
+        if i is None:
+            return default
+        return self.canon[i]
+
+# parser sessions
+
+class ParserSession:
+    """State of the parse of one document: its lexer, synonym table,
+    scope, instructions, and meta-variable counter.
+    
+    Parsers run in the current session, set by 'with session:'.
+    The grammar is shared by all sessions (see production), 
+    so documents can be parsed at the same time in threads, 
+    one session each.  The packrat table is shared, and 
+    should stay off when sessions run in threads."""
+    
+    def __init__(self):
+        self.tokenizer = lexer.tokenizer.clone()
+        self.synonyms = SynonymTable(word_lists.invariable)
+        self.scope = {}
+        self.instruct = {}
+        self.meta_count = 0
+        self._resets = []
+        
+    def __enter__(self):
+        self._resets.append(_session.set(self))
+        return self
+    
+    def __exit__(self,*exc):
+        _session.reset(self._resets.pop())
+        
+    def fork(self):
+        """A session for a part of the document parsed apart, 
+        sharing the synonyms, scope and instructions of this one,
+        to be read only, with its own lexer and meta-variable counter."""
+        s = copy.copy(self)
+        s.tokenizer = self.tokenizer.clone()
+        s.meta_count = 0
+        s._resets = []
+        return s
+        
+    def next_meta(self) -> int:
+        """the next meta-variable number"""
+        n = self.meta_count
+        self.meta_count += 1
+        return n
+    
+    def lex(self,s:str):
+        """list of the compact tokens of s, from the session lexer"""
+        self.tokenizer.lineno = 1
+        self.tokenizer.input(s)
+        return [lexer.Token.of(tok) for tok in self.tokenizer]
+    
+    def parse(self,pr,s:str) -> Item:
+        """run parser pr on string s in this session"""
+        with self:
+            return pr.process(init_item(self.lex(s)))
+
+# the session of module level parsing.
+default_session = ParserSession()
+_session = contextvars.ContextVar('parser_session',default=default_session)
 
-synonym = { key: key for key in word_lists.invariable }
+def current_session() -> ParserSession:
+    return _session.get()
+
+# tables of the default session
+synonyms = default_session.synonyms
+scope_current = default_session.scope
+
+# bump to drop all interned productions
+synonym_generation = 0
 
 MIN_LEN_SYNONYM = 4
 
 def synonym_add(ts):
-    """add synonym list to dictionary"""
+    """add synonym list to the table"""
     #XX Debug: should check that at most one variant in ts is defined anywhere.
     for s in ts:
         if len(s.split(' '))> 1:
             return msg.error(f'synonym entries must be single words:{s}')
-        if lexer.singularize(s) in synonym:
+        if lexer.singularize(s) in current_session().synonyms:
             return msg.error(f'synonym already declared: {s}')
         # len restriction prevents VAR from being added to dict.
         if len(s) < MIN_LEN_SYNONYM:
@@ -479,10 +1170,11 @@ def synonym_add(ts):
         if not(s.isalpha()):
             return msg.error(f'synonyms must be words: {s}')
     ls = [lexer.singularize(s) for s in ts]
-    ls.sort()
-    js = ' '.join(ls)
-    for s in ls:
-        synonym[s] = js
+    table = current_session().synonyms
+    for s in ls[1:]:
+        table.union(ls[0],s)
+    if len(ls) == 1:
+        table.add(ls[0])
         
 def synonymize(s:str) -> str:
     """get canonical synonymized form of s. item assumed lower case singular.
@@ -496,7 +1188,11 @@ def synonymize(s:str) -> str:
     """
     if len(s) < MIN_LEN_SYNONYM:
         return s
-    return synonym.get(s,s)
+    table = _session.get().synonyms
+    i = table.cls.get(s)
+    if i is None:
+        return s
+    return table.canon[i]
 
 #debug 
 #synonym_add(['world','andulux','awayto'])
@@ -510,6 +1206,117 @@ def synw(tok) -> str:
         s = s.lower()
     return synonymize(s)
 
+def token_keys(tok):
+    """Keys under which a token is looked up in first sets:
+    its type, its value, and its word value up to synonym."""
+    keys = [('type',tok.type),('value',tok.value)]
+    if can_wordify(tok):
+        keys.append(('word',synw(tok)))
+    return keys
+
+# interned grammar
+# Word parsers depend on the synonym table, so there is a grammar 
+# for each synonym table content (SynonymTable.key), shared by the 
+# sessions with that content.  Each maps (production name, arguments) 
+# to the parser built for them.  Only the latest few are kept.
+
+grammars = {}
+grammar_generation = 0
+GRAMMAR_VARIANTS = 16
+
+# held while productions are built, so other threads never see 
+# a partly built production.
+grammar_lock = threading.RLock()
+
+def current_grammar():
+    """the interned productions for the synonyms of the current session"""
+    global grammar_generation
+    key = _session.get().synonyms.key
+    gr = grammars.get(key)
+    if gr is not None and grammar_generation == synonym_generation:
+        return gr
+    with grammar_lock:
+        if grammar_generation != synonym_generation:
+            grammars.clear()
+            grammar_generation = synonym_generation
+        gr = grammars.get(key)
+        if gr is None:
+            gr = grammars[key] = {}
+            while len(grammars) > GRAMMAR_VARIANTS:
+                del grammars[next(iter(grammars))]
+        return gr
+
+def _hashable(x):
+    if isinstance(x,(list,tuple)):
+        return tuple(_hashable(y) for y in x)
+    return x
+
+def production(f):
+    """Decorator for parser constructors.
+    
+    The parser for given arguments is built once and then reused,
+    so the grammar is a graph of shared Parse nodes.  
+    A production reached again while it is being built gets a forward
+    placeholder, so recursive productions can be built.
+    Productions are looked up in the grammar for the synonyms of 
+    the current session, and built under grammar_lock.
+    The parser built is labelled for profiles (see _label); a production
+    returning the parser of another takes its label over."""
+    name = f.__qualname__
+    @functools.wraps(f)
+    def g(*args):
+        gr = current_grammar()
+        key = (name,_hashable(args))
+        try:
+            pr = gr.get(key)
+        except TypeError: # unhashable arguments
+            return f(*args)
+        if pr is not None and not(pr.kind == 'forward' and pr.target is None):
+            return pr
+        with grammar_lock:
+            # a forward here is from this thread, reaching key recursively
+            pr = gr.get(key)
+            if pr is not None:
+                return pr
+            fwd = Parse.forward(name)
+            gr[key] = fwd
+            try:
+                pr = f(*args)
+            except BaseException:
+                del gr[key]
+                raise
+            fwd.resolve(pr)
+            gr[key] = pr
+            pr.label = _label(name,args)
+            if profiler.enabled:
+                pr._wire()
+            return pr
+    return g
+
+def _label(name,args) -> str:
+    """label of a production, with its arguments that are names,
+    such as 'lit:is'"""
+    def arg(a):
+        if isinstance(a,(str,int)):
+            return str(a)
+        if isinstance(a,(list,tuple)):
+            return '|'.join(arg(b) for b in a)
+        return getattr(a,'__name__',None) or getattr(a,'label',None) or '_'
+    return ':'.join([name] + [arg(a) for a in args])
+
+def grammar_stats():
+    """Number of interned productions and of distinct Parse nodes reachable from them"""
+    gr = current_grammar()
+    seen = set()
+    stack = list(gr.values())
+    while stack:
+        p = stack.pop()
+        if id(p) in seen:
+            continue
+        seen.add(id(p))
+        stack.extend(p.children)
+    return {'productions' : len(gr), 'nodes' : len(seen)}
+
 def can_wordify(tok) -> bool:
     """True if token can be converted to a word token
     
@@ -521,22 +1328,23 @@ def can_wordify(tok) -> bool:
 
 def wordify(tok):
     """convert a var/word token to word token up to synonym"""
-    # need to (shallow) clone because of backtracking.
+    # a view, not a change to tok, because of backtracking.
     value = synw(tok)
     if tok.type == 'WORD' and tok.value == value:
         return tok
-    clone = copy.copy(tok)
-    clone.type = 'WORD'
-    clone.value = value
-    return clone
+    return lexer.derive(tok,'WORD',value)
 
 #def wordify_exact(tok):
 #    """convert a var/word token to a word exactly."""
 
 def word(p:Parse) -> Parse:
     """Parser treatment attempts to coerce token to a word token up to synonym."""
-    return p.if_test(can_wordify).treat(wordify).expect('word')
+    pr = p.if_test(can_wordify).treat(wordify).expect('word')
+    if p.yields == 'token':
+        pr.yields = 'word'
+    return pr
 
+@production
 def next_any_word() -> Parse: #was anyword
     """parser constructor that matches any next word"""
     return word(Parse.next_token())
@@ -546,6 +1354,7 @@ def next_any_word_except(ss):
         return not tok.value in ss
     return next_any_word().if_test(p)
 
+@production
 def next_value(v):
     """Parser constructor that accepts a token with given value."""
     return Parse.next_token().if_value(v)
@@ -559,6 +1368,7 @@ def next_value(v):
     #        return (False,None)
 #    return word(Parse.next_token()).if_value(s)
 
+@production
 def next_word(s:str) -> Parse: #was_next_word_syn
     """parser constructor that matches next word s, up to synonym"""
     #if len(s) < MIN_LEN_SYNONYM:
@@ -569,6 +1379,7 @@ def next_word(s:str) -> Parse: #was_next_word_syn
     return next_any_word().if_value(syn).expect(s)
     #Parse.next_token().if_test(p).treat(wordify).set_repr(f'wordsyn({s})')
 
+@production
 def next_any_word_except(banned) -> Parse:
     """parser constructor that matches any next word except banned.
     Matching on banned words is up to synonym."""
@@ -577,15 +1388,129 @@ def next_any_word_except(banned) -> Parse:
         return not(tok.value in bansyn)
     return next_any_word().if_test(p)
 
+@production
 def next_phrase(ss:str)-> Parse:
     """parser constructor that matches word phrase up to white space and synonyms."""
     phrase = [next_word(s) for s in ss.split()]
     return Parse.all(phrase).expect(ss)
 
+class PhraseTrie:
+    """Trie of word phrases keyed on canonical word values (see next_word).
+    
+    A node is a dictionary with
+      'next' : canonical word -> child node
+      'ends' : indices of phrases ending at the node
+      'through' : indices of phrases continuing past the node
+      'words' : index -> (canonical,raw) word of that phrase at the node
+    """
+    
+    def __init__(self,phs):
+        self.phrases = list(phs)
+        self.root = PhraseTrie._node()
+        for i,ph in enumerate(self.phrases):
+            node = self.root
+            for s in ph.split():
+                syn = synonymize(lexer.singularize(s))
+                node['through'].add(i)
+                node['words'][i] = (syn,s)
+                node = node['next'].setdefault(syn,PhraseTrie._node())
+            node['ends'].append(i)
+            
+    def _node():
+        return {'next':{},'ends':[],'through':set(),'words':{}}
+    
+    def first_words(self):
+        """canonical first words, or None if there is an empty phrase"""
+        if len(self.root['ends']) > 0:
+            return None
+        return set(self.root['next'])
+            
+    def match(self,item):
+        """Walk the stream from item.pos down the trie. 
+        Returns (winner,depth,ranout,fail), where winner is the least 
+        index of a phrase that matches, ranout the least index of a phrase
+        running past the end of the stream (or None), and fail is 
+        (index,depth,wordifiable) for the most progressed failure,
+        ties to the greatest index, or None."""
+        node = self.root
+        stream, pos = item.stream, item.pos
+        winner, depth, ranout, fail = None, 0, None, None
+        k = 0
+        while True:
+            for i in node['ends']:
+                if winner is None or i < winner:
+                    winner, depth = i, k
+            through = node['through']
+            if len(through) == 0:
+                break
+            if pos + k >= len(stream):
+                ranout = min(through)
+                break
+            tok = stream[pos + k]
+            child = None
+            wordifiable = can_wordify(tok)
+            if wordifiable:
+                child = node['next'].get(synw(tok))
+            failed = through if child is None else through.difference(
+                child['through'],child['ends'])
+            if len(failed) > 0 and k > 0:
+                fail = (max(failed),k,wordifiable)
+            if child is None:
+                break
+            node = child
+            k += 1
+        return (winner,depth,ranout,fail)
+    
+    def error_item(self,item,fail):
+        """Rebuild the error raised by next_phrase(ph) for the failure fail,
+        as seen after its expectations are added"""
+        (i,k,wordifiable) = fail
+        node = self.root
+        h = item.history
+        for j in range(k):
+            (syn,_) = node['words'][i]
+            node = node['next'][syn]
+            h = h.push(['next-item',item.pos+j,item.pos+j+1])
+        q = item.pos + k
+        (syn,s) = node['words'][i]
+        es = [] if wordifiable else [['expecting:word',q,q]]
+        es += [[f'expecting:{syn}',q,q],[f'expecting:{s}',q,q],
+               [f'expecting:{self.phrases[i]}',item.pos,item.pos]]
+        return Item(pos=q,stream=item.stream,
+                    acc=wordify(item.stream[q-1]),history=h.extend(es))
+
+@production
+def any_phrase(phs) -> Parse:
+    """parser constructor for the first matching phrase in phs,
+    up to white space and synonyms.  
+    Same as Parse.first([next_phrase(ph) for ph in phs]),
+    but matched through a PhraseTrie, in time proportional to the 
+    phrase length, not the number of phrases."""
+    trie = PhraseTrie(phs)
+    def f(item):
+        (winner,depth,ranout,fail) = trie.match(item)
+        if ranout is not None and (winner is None or ranout < winner):
+            raise StopIteration
+        if winner is None:
+            if fail is None:
+                return Failure(item)
+            return Failure(trie.error_item(item,fail))
+        h = item.history
+        toks = item.stream[item.pos:item.pos+depth]
+        for j in range(depth):
+            h = h.push(['next-item',item.pos+j,item.pos+j+1])
+        return Item(pos=item.pos+depth,stream=item.stream,
+                    acc=[wordify(tok) for tok in toks],history=h)
+    ws = trie.first_words()
+    first = None if ws is None else frozenset(('word',w) for w in ws)
+    return Parse(step=f,kind='phrases',first=first)
+
+@production
 def first_phrase(phs)-> Parse: #was somephrase
     """parser constructor for the first matching phrase up to white space and synonyms"""
-    return Parse.first([next_phrase(ph) for ph in phs]).expect('first:'+ '/'.join(phs))
+    return any_phrase(phs).expect('first:'+ '/'.join(phs))
 
+@production
 def first_word(ss:str) -> Parse: #was someword
     """parser constructor for the first matching word up to white space and syns"""
     return Parse.first([next_word(s) for s in ss.split(' ')]).expect('first:'+ss)
@@ -602,10 +1527,13 @@ def first_word(ss:str) -> Parse: #was someword
 
 def commit(msg:str, probe:Parse, pr:Parse) -> Parse:
     """if trial_parse does not fail, discard, then apply pr without catching"""
+    pr1 = pr.nocatch(msg)
     def f(item):
-        probe.process(item)
-        return pr.nocatch(msg).process(item)
-    return Parse(f)
+        r = probe.step(item)
+        if r.__class__ is Failure:
+            return r
+        return pr1.step(item)
+    return Parse(step=f,children=[probe,pr1],kind='commit',first=probe.first)
         
 ##def commit_head(msg:str,head:Parse,pr2) -> Parse:
 #    """compose parsers applying head, then pr2(output data) with nocatch"""
@@ -618,10 +1546,13 @@ def if_then_else(probe:Parse,pr1:Parse,pr2:Parse)-> Parse:
     """if probe fails do pr2, otherwise pr1"""
     def f(item):
         try:
-            probe.process(item)
-        except:
-            return pr2.process(item)
-        return pr1.process(item) 
+            r = probe.step(item)
+        except StopIteration:
+            return pr2.step(item)
+        if r.__class__ is Failure:
+            return pr2.step(item)
+        return pr1.step(item) 
+    return Parse(step=f,children=[probe,pr1,pr2],kind='if_then_else')
 
 #def until(pr1:Parse,pr2:Parse) -> Parse:
 #    """accumulate pr1's in a list until pr2 succeeds, including pr2 output"""
@@ -637,52 +1568,75 @@ def if_then_else(probe:Parse,pr1:Parse,pr2:Parse)-> Parse:
 #            return update(t(item1.acc,item2.acc),item2)
 #    return Parse(f)
 
+@production
 def delimit(pr:Parse,left:str,right:str) -> Parse:
     """delimit a parser"""
     def flat(tok):
-        ((a,b),c)=tok
-        b = b if type(b) is list else [b]
+        (a,b,c)=tok
+        # a token stream builds its tokens anew, so tokens are compared by position
+        if (b.__class__ is lexer.TokenSpan and 0 < b.start and b.stop < len(b.stream)
+            and b.stream[b.start - 1].lexpos == a.lexpos and b.stream[b.stop].lexpos == c.lexpos):
+            return lexer.TokenSpan(b.stream,b.start - 1,b.stop + 1)
+        b = list(b) if isinstance(b,(list,lexer.TokenSpan)) else [b]
         return [a]+b+[c]
-    return (next_value(left)+pr+next_value(right)).treat(flat)
+    return Parse.seq([next_value(left),pr,next_value(right)]).treat(flat)
 
+@production
 def delimit_strip(pr:Parse,left:str,right:str) -> Parse:
     """delimit a parser, discarding delimiters"""
     def take_middle(tok):
         return tok[1:-1]
     return delimit(pr,left,right).treat(take_middle)
 
+@production
 def paren(pr): 
     return delimit_strip(pr,'(',')')
     
+@production
 def bracket(pr): 
     return delimit_strip(pr,'[',']')
         
+@production
 def brace(pr):
     return delimit_strip(pr,'{','}')
 
+@production
 def option_paren(pr):
     return paren(pr) | pr 
 
 def lambda_true(_):
     return True
 
+@production
+def balanced_run(b):
+    """parser for a run of tokens passing test b, as a span"""
+    return Parse.next_token().if_test(b).skip(1).span()
+
+@production
+def balanced_delimited(left,right):
+    """parser for balanced tokens between delimiters"""
+    return (delimit(balanced_condition(lambda_true),left,right)).expect('left delimiter')
+
 def balanced_cases(b):
     #print('bc-toks')
-    yield Parse.next_token().if_test(b).plus() #,[b_not_delimiter]
+    yield balanced_run(b) #,[b_not_delimiter]
     for left,right in [('(',')'),('[',']'),('{','}')]:
         #print(f'bc-delim-{left}{right}')
-        yield (delimit(balanced_condition(lambda_true),left,right)).expect('left delimiter')
+        yield balanced_delimited(left,right)
 
+@production
 def balanced_condition(b) -> Parse:  #was balanced B
-    """get list of balanced delimited tokens, applying token condition b at outermost level"""
+    """get span of balanced delimited tokens, applying token condition b at outermost level"""
     def b_not_delimiter(tok):
         return not(tok.value in ['(',')','{','}','[',']']) and b(tok)  
 #        return r
-    return Parse.gen_first(balanced_cases,[b_not_delimiter]).many().treat(lib.flatten)
+    return Parse.gen_first(balanced_cases,[b_not_delimiter]).skip().span()
 
+@production
 def balanced() -> Parse:
     return balanced_condition(lambda_true)
 
+@production
 def brace_semi():
     """construct parser for brace-delimited delimiter-balanced semicolon separated list"""
     def p(tok):
@@ -690,16 +1644,19 @@ def brace_semi():
     nosemi = balanced_condition(p).expect('no ;')
     return brace(Parse.separated_nonempty_list(nosemi,next_value(';')))
     
+@production
 def comma_nonempty_list(pr:Parse) -> Parse:
     """construct parser for comma-separated list"""
     return Parse.separated_nonempty_list(pr,next_value(','))
 
 andcomma = next_value(',') | next_value('and')
 
+@production
 def andcomma_nonempty_list(pr:Parse) -> Parse:
     """construct parser for and/comma separated list"""
     return Parse.separated_nonempty_list(pr,andcomma)
 
+@production
 def or_nonempty_list(pr:Parse) -> Parse:
     """construct parser for 'or' separated list"""
     return Parse.separated_nonempty_list(pr,next_value('or'))
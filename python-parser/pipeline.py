@@ -0,0 +1,176 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Streaming parse of a document in bounded memory.
+
+    reader -> lexer -> statement cutter -> parser -> sink
+
+The reader reads the input ahead, a chunk at a time (see read_chunks).
+The lexer lexes the chunks as they come (see lexer.lex_chunks), and
+the cutter passes on each statement as soon as it ends (see
+batch.cut_statements).  The parser parses the statements in order,
+in one session, so that declarations apply to the statements after
+them.  The sink gets the result of each statement, in order.
+
+The reader, the lexer with the cutter, and the parser run in threads
+of their own, connected by queues of at most QUEUE_SIZE items.
+Memory is then bounded by the queues and the largest statement, not
+by the length of the input: the tokens of a statement are released
+once the sink is done with its result.
+
+usage: python pipeline.py [-q] files...
+Prints the failed statements, and a summary line per file.
+"""
+
+import sys
+import os
+import time
+import queue
+import argparse
+import resource
+import threading
+import lexer
+import parser_combinator as c
+import production_rules as p
+import batch
+
+READ_SIZE = 1 << 16
+QUEUE_SIZE = 16
+
+def read_chunks(fp,size=READ_SIZE):
+    """Generate the chunks of size bytes of a binary file"""
+    while True:
+        chunk = fp.read(size)
+        if not chunk:
+            return
+        yield chunk
+
+# queue plumbing between the stages.
+# A stage puts its items on its queue, then _END, or its exception.
+# All stages give up when stop is set.
+
+_END = object()
+
+class _Failed:
+    def __init__(self,error):
+        self.error = error
+
+def _put(q,x,stop) -> bool:
+    while not(stop.is_set()):
+        try:
+            q.put(x,timeout=0.1)
+            return True
+        except queue.Full:
+            pass
+    return False
+
+def _drain(q,stop):
+    """Generate the items of a stage from its queue"""
+    while not(stop.is_set()):
+        try:
+            x = q.get(timeout=0.1)
+        except queue.Empty:
+            continue
+        if x is _END:
+            return
+        if isinstance(x,_Failed):
+            raise x.error
+        yield x
+
+def _pump(items,q,stop):
+    """run a stage: put the items of iterable items on q"""
+    try:
+        for x in items:
+            if not(_put(q,x,stop)):
+                return
+        _put(q,_END,stop)
+    except Exception as e:
+        _put(q,_Failed(e),stop)
+
+def stream(source,prs=p.top_statement,session=None,
+           read_size=READ_SIZE,queue_size=QUEUE_SIZE):
+    """Generate the StatementResult of each statement of source, a path
+    or a binary file, in order, through the pipeline.  start and stop
+    count tokens from the start of source.  prs() parses a statement,
+    in session (default a new session), as in batch.parse_statement."""
+    session = session or c.ParserSession()
+    fp = open(source,'rb') if isinstance(source,(str,os.PathLike)) else source
+    stop = threading.Event()
+    chunks = queue.Queue(queue_size)
+    windows = queue.Queue(queue_size)
+    results = queue.Queue(queue_size)
+
+    def cut():
+        return batch.cut_statements(lexer.lex_chunks(_drain(chunks,stop),session.tokenizer))
+
+    def parse():
+        start = 0
+        for (window,ended,effect) in _drain(windows,stop):
+            r = batch.parse_statement(window,batch.Statement(0,len(window),ended,effect),
+                                      prs,session)
+            yield r._replace(start=start,stop=start + len(window))
+            start += len(window)
+
+    threads = [threading.Thread(target=_pump,args=args,daemon=True)
+               for args in [(read_chunks(fp,read_size),chunks,stop),
+                            (cut(),windows,stop),
+                            (parse(),results,stop)]]
+    for t in threads:
+        t.start()
+    try:
+        yield from _drain(results,stop)
+    finally:
+        stop.set()
+        for t in threads:
+            t.join()
+        if fp is not source:
+            fp.close()
+
+class Summary:
+    """Sink counting the statements, tokens and errors of a stream"""
+
+    def __init__(self):
+        self.statements = 0
+        self.tokens = 0
+        self.errors = 0
+        self.largest = 0 # tokens of the largest statement
+
+    def __call__(self,r:batch.StatementResult):
+        self.statements += 1
+        self.tokens += r.stop - r.start
+        self.errors += r.error is not None
+        self.largest = max(self.largest,r.stop - r.start)
+
+def run(source,sink,**kw) -> int:
+    """Pass the results of stream(source,**kw) to sink, a callable.
+    Returns the number of statements."""
+    n = 0
+    for r in stream(source,**kw):
+        sink(r)
+        n += 1
+    return n
+
+def main(argv):
+    ap = argparse.ArgumentParser(description='Parse documents as streams of statements.')
+    ap.add_argument('paths',nargs='+',help='files to parse')
+    ap.add_argument('-q','--quiet',action='store_true',
+                    help='print the summaries only')
+    args = ap.parse_args(argv[1:])
+    errors = 0
+    for path in args.paths:
+        t = time.perf_counter()
+        summary = Summary()
+        def sink(r):
+            summary(r)
+            if r.error is not None and not(args.quiet):
+                print(f'{path}: tokens {r.start}-{r.stop}: {r.error}')
+        run(path,sink)
+        rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+        print(f'{path}: {summary.statements} statements, {summary.tokens} tokens, '
+              f'{summary.errors} errors in {time.perf_counter() - t:.3f}s '
+              f'(largest statement {summary.largest} tokens, peak rss {rss:.0f} MB)')
+        errors += summary.errors
+    return 1 if errors else 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
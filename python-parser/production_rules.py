@@ -8,7 +8,7 @@ Created on Sat Aug 22 17:00:38 2020
 
 """production rules for Colada"""
 
-import copy
+from collections.abc import Mapping
 import msg
 import word_lists
 import lib
@@ -41,16 +41,18 @@ def reparse(s:str) -> Parse:
         raise k
         
 
+@c.production
 def cs_brace(cs_parse:Parse,brace_parse:Parse) -> Parse:
     """control sequence parser including arguments in braces.
     cs_parse is used to parse cs and brace_parse to parse each braced arg."""
     return cs_parse + c.brace(brace_parse).many()
 
+@c.production
 def phrase_list_transition():
     """parser for transition phrases"""
-    prs = [next_phrase(s) for s in word_lists.transition]
-    return (Parse.first(prs) + next_word('that').possibly()).nil()
+    return (c.any_phrase(word_lists.transition) + next_word('that').possibly()).nil()
 
+@c.production
 def phrase_list_filler():
     """parser for filler words"""
     return (Parse.word('we').possibly() + first_word('put write have know see') + 
@@ -63,23 +65,26 @@ def phrase_list_filler():
 # wordlike atomic identifiers are case insensitive and can have synonym.
 #  but hierarchical identifiers are always case sensitive.
 
+@c.production
 def atomic():
     #I forget why I am converting integers.
     """parser for atomic identifiers, converting words and integers as needed"""
+    next_token = Parse.next_token()
     def f(item):
-        item1 = Parse.next_token().process(item)
-        result = item1.tok
+        item1 = next_token.process(item)
+        result = item1.acc
         if result.type == 'INTEGER' or result.type == 'WORD':
-            tok = copy.copy(result)
-            if tok.type == 'WORD':
-                tok.value = c.synonymize(tok.value)
-            tok.type = 'ATOMIC_IDENTIFIER'
-            return (tok,item1)
+            value = result.value
+            if result.type == 'WORD':
+                value = c.synonymize(value)
+            tok = lexer.derive(result,'ATOMIC_IDENTIFIER',value)
+            return c.update(tok,item1)
         if result.type == 'ATOMIC_IDENTIFIER':
-            return result
+            return item1
         raise ParseError(item)
-    return Parse(f).expect('atomic')
+    return Parse(f,[next_token]).expect('atomic')
 
+@c.production
 def expr():
     """parse for expression (term, type, or prop)."""
     def p(tok):
@@ -87,84 +92,94 @@ def expr():
         return not(tok.value in [';','.'])
     return reparse('expr').process(c.balanced_condition(p))
 
+@c.production
 def assign_expr():
     """parser for := followed by an expression
     The output is the expression
     """
     return (next_value(':=') + expr()).treat(lib.snd)
 
+@c.production
 def var():
     """parser for a single variable.
     Accepts a single token that is a variable."""
     return Parse.next_token().if_type(['VAR']).expect('var')
 
+@c.production
 def var_or_atomic():
     """parser for a var or atomic identifier.
     Output of parser is a single token of one of those types."""
     return (var() | atomic()).expect('var_or_atomic')
 
+@c.production
 def var_or_atomics():
     """parser for a sequence of one or more var or atomics"""
     return Parse.plus(var_or_atomic())
 
+@c.production
 def var_or_atomic_or_blank():
     """parser for var or atomic or _.
     The parser output is a single token that is one of those types."""
     return var_or_atomic() | next_value('_')
 
+@c.production
 def hierarchical_identifier():
     """parser for hierarchical identifiers.
     Parser output is a single token."""
     return Parse.next_token().if_type(['HIERARCHICAL_IDENTIFIER'])
 
+@c.production
 def identifier():
     """parser for hierarchical or atomic identifier.
     Parser output is a single token"""
     return (atomic() | hierarchical_identifier()).expect('identifier')
 
 # canned phrases that have small variants
-# lit[w] gives parser for w-like words or phrases
-    
-lit_dict = {
-    'a' : first_word('a an'), #indefinite
-    'article' : first_word('a an the'),
-    'defined-as' : first_phrase(['said to be','defined as','defined to be']),
-    'is' : first_phrase(['is','are','be','to be']),
-    'iff':  (first_phrase(['iff','if and only if']) | 
+# lit(w) and lit_dict[w] give parser for w-like words or phrases.
+# The parsers are built by lit_rules[w]() on first use, not on import, 
+# in the grammar of the synonyms of the current session (see production).
+    
+lit_rules = {
+    'a' : lambda : first_word('a an'), #indefinite
+    'article' : lambda : first_word('a an the'),
+    'defined-as' : lambda : first_phrase(['said to be','defined as','defined to be']),
+    'is' : lambda : first_phrase(['is','are','be','to be']),
+    'iff':  lambda : (first_phrase(['iff','if and only if']) | 
              (first_phrase(['is','are','be','to be']) + next_word('the').possibly() + next_word('predicate'))),
-    'denote': first_phrase(['denote','stand for']),
-    'do': first_word('do does'),
-    'equal': next_phrase('equal to'),
-    'has': first_word('has have'),
-    'with': first_word('with of having'),
-    'true': first_word('on true yes'),
-    'false': first_word('off false no'),
-    'wrong': next_phrase('it is wrong that'),
-    'exist': next_word('exist'),
-    'lets': first_phrase(['let','let us','we','we can']),
-    'fix': first_word('fix let'),
-    'assume': first_word('assume suppose'),
-    'then': first_word('then therefore hence'),
-    'choose': first_word('take choose pick'),
-    'prove': first_word('prove show'),
-    'say': first_word('say write'),
-    'we-say': (next_word('we').possibly() +
+    'denote': lambda : first_phrase(['denote','stand for']),
+    'do': lambda : first_word('do does'),
+    'equal': lambda : next_phrase('equal to'),
+    'has': lambda : first_word('has have'),
+    'with': lambda : first_word('with of having'),
+    'true': lambda : first_word('on true yes'),
+    'false': lambda : first_word('off false no'),
+    'wrong': lambda : next_phrase('it is wrong that'),
+    'exist': lambda : next_word('exist'),
+    'lets': lambda : first_phrase(['let','let us','we','we can']),
+    'fix': lambda : first_word('fix let'),
+    'assume': lambda : first_word('assume suppose'),
+    'then': lambda : first_word('then therefore hence'),
+    'choose': lambda : first_word('take choose pick'),
+    'prove': lambda : first_word('prove show'),
+    'say': lambda : first_word('say write'),
+    'we-say': lambda : (next_word('we').possibly() +
             first_word('say write') +
             next_word('that').possibly()
             ),
-    'assoc': first_word('left right no'),
-    'field-key': first_word('coercion notationless notation parameter type call'),
-    'qed': first_word('end qed obvious literal'),
-    'document': first_word('document article section subsection subsubsection subdivision division'),
-    'end-document': first_word('endsection endsubsection endsubsubsection enddivision endsubdivision'),
-    'def': first_word('def definition'),
-    'axiom': first_word('axiom conjecture hypothesis equation formula'),
-    'with-property': next_phrase('with property'),
-    'param': next_phrase('with parameter'),
-    'theorem': first_word('proposition theorem lemma corollary'),
+    'assoc': lambda : first_word('left right no'),
+    'field-key': lambda : first_word('coercion notationless notation parameter type call'),
+    'qed': lambda : first_word('end qed obvious literal'),
+    'document': lambda : first_word('document article section subsection subsubsection subdivision division'),
+    'end-document': lambda : first_word('endsection endsubsection endsubsubsection enddivision endsubdivision'),
+    'def': lambda : first_word('def definition'),
+    'axiom': lambda : first_word('axiom conjecture hypothesis equation formula'),
+    'with-property': lambda : next_phrase('with property'),
+    'param': lambda : next_phrase('with parameter'),
+    'theorem': lambda : first_word('proposition theorem lemma corollary'),
     # type proposition property classsifier atomic 
     }
 
+@c.production
 def lit(s):
     """parser generator for 's'-like words or phrases"""
     if s in ['record','doc','location']:
@@ -174,10 +189,26 @@ def lit(s):
                     Parse.word('identification').possibly() +
                     Parse.word('that').possibly())
         if s == 'doc':
-            return lit['document'] | lit['end-document']
+            return lit('document') | lit('end-document')
         if s == 'location':
-            return Parse.first([lit_dict['document'],lit_dict['theorem'],lit_dict['axiom']])
-    return lit_dict[s]
+            return Parse.first([lit('document'),lit('theorem'),lit('axiom')])
+    return lit_rules[s]()
+
+class LitDict(Mapping):
+    """Read-only dictionary of the parsers lit(w) for w in lit_rules"""
+    
+    def __getitem__(self,w):
+        if w not in lit_rules:
+            raise KeyError(w)
+        return lit(w)
+    
+    def __iter__(self):
+        return iter(lit_rules)
+    
+    def __len__(self):
+        return len(lit_rules)
+
+lit_dict = LitDict()
 
 #others:
 #label = atomic
@@ -187,13 +218,34 @@ comma = next_value(',')
 semicolon = next_value(';')
 colon = next_value(':')
 
+def not_period(tok):
+    return tok.value != '.'
+
+@c.production
+def statement():
+    """Parser for the balanced tokens of a statement, 
+    up to its period at bracket depth 0. The period is discarded."""
+    return (c.balanced_condition(not_period) + next_value('.')).treat(lib.fst)
+
+@c.production
+def statements():
+    """Parser for a document as a list of statements.
+    Tokens after the last period make a last statement."""
+    def trt(acc):
+        (sts,rest) = acc
+        return sts + [rest] if rest else sts
+    return (statement().many() + c.balanced() + Parse.finished()).treat(lib.fst).treat(trt)
+
 #renamed map -> call
 
-# instructions do nothing except store for now
+# instructions do nothing except store for now,
+# in the instruction table of the current session.
 
-instruct = {}
+instruct = c.default_session.instruct
 
 class Instruction:
+    
+    keywords = 'exit timelimit printgoal dump ontored read library error warning'
 
     def _param_value(ls):
         if ls == []:
@@ -219,13 +271,15 @@ class Instruction:
     #print(expand_slashdash(['work','/-','ing','/','effort','workaround']))
     #['work', 'working', 'effort', 'workaround']
     
+    @c.production
     def _syn():
         """parsing synonyms"""
         def p(tok):
-            tok.value in ['/','/-'] or c.can_wordify(tok)
+            return tok.value in ['/','/-'] or c.can_wordify(tok)
         synlist = Parse.next_token().if_test(p).plus()
         return c.comma_nonempty_list(synlist)
     
+    @c.production
     def instruction():
         """parsing and processing of synonyms and other instructions"""
         def treat_syn(acc):
@@ -233,17 +287,25 @@ class Instruction:
                 vs = [t.value for t in ac]
                 v_expand = Instruction._expand_slashdash(vs)
                 c.synonym_add(v_expand)
-                return ()
+            return ()
         def treat_instruct(acc):
             keyword,ls = acc
-            instruct[keyword.value] = Instruction._param_value(ls)
+            c.current_session().instruct[keyword.value] = Instruction._param_value(ls)
             return ()
-        keyword_instruct = (first_word("""exit timelimit printgoal dump 
-                         ontored read library error warning""") + 
-                         Parse.next_token().possibly())
-        return (c.bracket(next_word('synonym') + Instruction._syn().treat(treat_syn) |
-             c.bracket(keyword_instruct.treat(treat_instruct))))
+        def not_right(tok):
+            return tok.value != ']'
+        keyword_instruct = (first_word(Instruction.keywords) + 
+                         Parse.next_token().if_test(not_right).possibly())
+        return (c.bracket(next_word('synonym') + Instruction._syn().treat(treat_syn).nomemo()) |
+             c.bracket(keyword_instruct.treat(treat_instruct).nomemo()))
  
+@c.production
+def top_statement():
+    """Parser for a statement of a document: 
+    an instruction, or balanced tokens ended by a period."""
+    return Instruction.instruction() | statement()
+
+@c.production
 def this_exists():
     """parsing of 'this'-directives.
     DEBUG: Remove this feature. Deprecated Unfinished"""
@@ -256,21 +318,22 @@ def this_exists():
         return c.andcomma_nonempty_list(Parse.next_token().if_test(adjective))
     return first_phrase(['this exist','this is'])
 
+@c.production
 def post_colon_balanced():
     def p(token):
         return token.value not in ['end','with',':=',';','.',',','|',':']
     return c.balanced_condition(p)
 
 def meta_tok():
-    tok = c.mk_token({'type':'META','value':str(meta_tok.count)})
-    meta_tok.count += 1
-    return tok
+    n = c.current_session().next_meta()
+    return c.mk_token({'type':'META','value':str(n)})
 #    tok = copy.copy(c.init_item.tok)
 #    tok.value = str(meta_tok.count)
 #    tok.type = 'META'
 #    meta_tok.count += 1
 #    return tok 
 
+@c.production
 def colon_annotation(prs):  #was opt_colon_type, opt_colon_sort
     """Parser for ': A', discarding the colon. 
     A is parsed by prs.
@@ -282,6 +345,7 @@ def colon_annotation(prs):  #was opt_colon_type, opt_colon_sort
     prs1= (next_value(':') + post_colon_balanced()).treat(lib.snd).possibly().treat(lib.fflatten)
     return prs1.reparse(prs)
 
+@c.production
 def colon_annotation_or_meta(prs): #was opt_colon_type_meta, opt_colon_sort_meta
     """Parser for annotation ': A', discarding the colon.
     If no annotation, parser returns a meta-variable.
@@ -290,7 +354,7 @@ def colon_annotation_or_meta(prs): #was opt_colon_type_meta, opt_colon_sort_meta
         if acc == [] or acc == None:
             return meta_tok()
         return acc
-    return colon_annotation(prs).treat(trt)
+    return colon_annotation(prs).treat(trt).nomemo()
 
 # differ only in treatment
 #def opt_colon_sort():
@@ -299,6 +363,7 @@ def colon_annotation_or_meta(prs): #was opt_colon_type_meta, opt_colon_sort_meta
 #def opt_colon_sort_meta():
 #    return opt_colon_type_meta()
 
+@c.production
 def annotated_var(prs):
     """
     Parser for annotated variable in parentheses.  
@@ -319,6 +384,7 @@ def annotated_var(prs):
 #def annotated_sort_vars():
 #    return c.paren(var().plus() + opt_colon_type_meta())
 
+@c.production
 def annotated_vars(prs):
     """Parser for list of annotated variables, parsing annotation with prs
     
@@ -339,11 +405,13 @@ def annotated_vars(prs):
         return [c.copy_token(v,ann[0]) for v in vs]
     return c.paren(var().plus() + colon_annotation_or_meta()).treat(trt)
 
+@c.production
 def let_annotation_prefix():
     return (next_word('let') + c.comma_nonempty_list(var()) +
      next_word('be') + lit('a').possibly() +
      next_word('fixed').possibly())
     
+@c.production
 def let_annotation():
     """Parser for let_annotations. Terminating punctuation not included.
     
@@ -358,16 +426,19 @@ def let_annotation():
     return ((first_word( 'fix let') + c.comma_nonempty_list(annotated_sort_vars)) |
      let_annotation_prefix() + post_colon_balanced())
 
+@c.production
 def brace_assign():
     def brace_assign_item():
         return (var_or_atomic_or_blank()+ opt_colon_sort() + assign_expr().possibly())
     return c.brace_semi().reparse_list(brace_assign_item)
 
+@c.production
 def brace_noassign():
     def brace_noassign_item():
         return (var_or_atomics() + opt_colon_sort_meta())
     return c.brace_semi().reparse_list(brace_noassign_item())
 
+@c.production
 def nonkey(): #was not_banned
     keyword = [
         'is','be','are','denote','define','enter','namespace','stand',
@@ -378,6 +449,7 @@ def nonkey(): #was not_banned
         return not(c.singularize(token.value) in keyword)
     return c.next_type(['VAR','WORD','ATOMIC_IDENTIFIER']).if_test(p)
 
+@c.production
 def args_template():
     """Form of arguments to a function declaration"""
     def required_arg_template_pat():
@@ -387,17 +459,21 @@ def args_template():
             )
     return (brace_noassign().possibly() + required_arg_template_pat().many())
 
+@c.production
 def any_controlseq(): #was controlseq
     return c.next_type(['CONTROLSEQ'])
 
+@c.production
 def controlseq(s): #was the_controlseq
     """Parser for a particular control sequence 's'.
     s includes the backslash."""
     return any_controlseq().if_value(s)
 
+@c.production
 def any_symbol(): # was symbol
     return c.next_type(['SYMBOL'])
 
+@c.production
 def symbol(s): # was the_symbol
     return any_symbol().if_value(s)
 
@@ -408,6 +484,7 @@ def symbol(s): # was the_symbol
 class Proof:
     """Parser constructors for proof statements"""
     
+    @c.production
     def canned():
         """parser for canned proof statements"""
         return (next_phrase("we proceed as follows") |
@@ -418,32 +495,41 @@ class Proof:
                 next_phrase('the other cases are similar') |
                 (next_phrase('the proof is')+ first_word('obvious trivial easy routine'))).nil().expect('canned')
 
+    @c.production
     def then_prefix():
         return lit('then').possibly()
     
+    @c.production
     def assumption():
         assumption_prefix = lit('lets')+ lit('assume') + next_word('that').possibly()
         return ((assumption_prefix + c.balanced() + period) |
                 let_annotation() + period)
     
+    @c.production
     def possibly_assumption():
         return (Proof.assumption().many() + Proof.then_prefix())
     
+    @c.production
     def axiom_preamble():
         return lit('axiom')+ atomic().possibly() + period
     
+    @c.production
     def moreover_statement():
         return next_word('moreover') + c.balanced() + period
     
+    @c.production
     def axiom():
         return Proof.axiom_preamble() + Proof.possibly_assumption() + c.balanced() + period + Proof.moreover_statement.many()
     
+    @c.production
     def ref_item():
         return c.andcomma_nonempty_list(lit('location').possibly() + atomic())
     
+    @c.production
     def by_ref():
         return c.paren(next_word('by') + Proof.ref_item()).possibly()
     
+    @c.production
     def by_method():
         def no_that(tok):
             return tok.value == 'that' # exclude avoids goal_prefix ambig.
@@ -453,44 +539,57 @@ class Proof:
                    (next_word('on') + c.balanced_condition(no_that)).possibly())) +
                  Parse.probe(next_word('that')| period))
     
+    @c.production
     def choose_prefix():
         return Proof.then_prefix() + lit('lets').possibly() + lit('choose')
     
+    @c.production
     def canned_prefix():
         return c.andcomma_nonempty_list(phrase_list_transition())
     
+    @c.production
     def goal_prefix():
         return ((lit('lets').possibly() + lit('prove') + next_word('that')) |
                    (Proof.by_method() + next_word('that')).possibly())
     
+    @c.production
     def preamble():
         return ((next_word('proof') + Proof.by_method().possibly() + period) |
                       next_word('indeed'))
     
+    @c.production
     def affirm():
         return Proof.statement() | Proof.goal()
     
+    @c.production
     def statement():
         return Proof.then_prefix() + c.balanced() + Proof.by_ref() + period + Proof.moreover_statement.many() + Proof.script.possibly()
     
+    @c.production
     def goal():
         return Proof.goal_prefix + c.balanced() + Proof.by_ref() + period + Proof.script()
 
+    @c.production
     def script():
         return (Proof.preamble + (Proof.canned_prefix() + Proof.body() + Proof.canned_prefix + Proof.tail).many() + lit('qed') + period)
     
+    @c.production
     def body():
         return (Proof.tail() |  Proof.assumption())
     
+    @c.production
     def tail():
         return (Proof.affirm() | Proof.canned() | Proof.case() | Proof.choose())
     
+    @c.production
     def case():
         return (next_word('case') + c.balanced() + period + Proof.choose_justify())
     
+    @c.production
     def choose():
         return (Proof.choose_prefix + c.balanced() + period + Proof.justify())
     
+    @c.production
     def justify():
         return (Proof.script().possibly())
 
@@ -508,6 +607,7 @@ pattern_key = ["is","be","are","denote","define"
 class Pattern:
     """Parser generators for patterns"""
     
+    @c.production
     def _nonkey():
         """Parser for any word except for keywords.  
         The token must be a WORD."""
@@ -517,62 +617,75 @@ class Pattern:
             return tok.type == 'WORD' and not_key(tok.value)
         return next_word().if_test(p)
     
+    @c.production
     def _nonkey_extended():
         """parser for 'word (or word) (paren stuff)'.
         (or word) gives a synonym as a parenthetical within
         a word pattern.  Side effect is a new global synonym."""
-        p = ((Pattern._nonkey() + 
-             c.paren((next_word('or') + Pattern._nonkey()).treat(lib.snd).plus()).possibly()) +
-             c.paren(Pattern._nonkey().plus()).many())
+        p = Parse.seq([Pattern._nonkey(), 
+             c.paren((next_word('or') + Pattern._nonkey()).treat(lib.snd).plus()).possibly(),
+             c.paren(Pattern._nonkey().plus()).many()])
         def f(item):
             item1 = p.process(item)
-            ((a,bs),cs) = item1.acc
+            (a,bs,cs) = item1.acc
             vals = [a.value]+ [i.value for i in bs]
             c.synonym_add(vals)
             return c.update((a,cs),item1)
-        return Parse(f)
+        return Parse(f,[p]).nomemo()
     
+    @c.production
     def _var():
         """parser for a variable appearing in a pattern"""
         return var() | c.paren(var() + opt_colon_sort)
     
+    @c.production
     def _nonkey_words():
         return Pattern._nonkey_extended().plus()
     
+    @c.production
     def word_pattern():
         """Parser for a word pattern, consisting of variables, 
         words, and pattern parentheticals"""
         return Pattern._nonkey_words() + (Pattern._var() + Pattern._unkey_words()).many() + Pattern._var().possibly()
         
+    @c.production
     def type_word_pattern():
         return lit('a').possibly() + Pattern.word_pattern()
     
+    @c.production
     def function_word_pattern():
         return next_word('the') + Pattern.word_pattern()
     
+    @c.production
     def notion_pattern(): 
         return Pattern._var() + next_word('is') + lit('a') + Pattern.word_pattern()
     
+    @c.production
     def adjective_pattern():
         return Pattern._var() + next_word('is') + next_word('called').possibly() + Pattern.word_pattern()
     
+    @c.production
     def var_multisubsect_pattern():
         return (
         (Pattern._var() + next_value(',') + Pattern._var()) |
         c.paren(Pattern._var() + next_value(',') + Pattern._var() + opt_colon_type_meta())
         )
     
+    @c.production
     def adjective_multisubject_pattern():
         return (
         Pattern.var_multisubsect_pattern() + next_word('are') + next_word('called').possibly() + Pattern.word_pattern()
         )
         
+    @c.production
     def verb_pattern(): 
         return  Pattern._var() + Pattern.word_pattern()
         
+    @c.production
     def verb_multisubject_pattern():
         return (Pattern.var_multisubsect_pattern() + Pattern.word_pattern())
         
+    @c.production
     def predicate_word_pattern():
         return (
             Pattern.notion_pattern() |
@@ -582,13 +695,16 @@ class Pattern:
             Pattern.verb_multisubject_pattern()
             )
     
+    @c.production
     def controlseq_pattern():
         return any_controlseq() + c.brace(Pattern._var()).many()
     
+    @c.production
     def binary_controlseq_pattern():
         return Pattern._var() + Pattern.controlseq_pattern() + Pattern._var()
     
   
+    @c.production
     def precedence_level(): #was paren_precedence_level
         """parser for the precedence level.
         
@@ -612,6 +728,7 @@ class Pattern:
         return Pattern._precedence_level() | c.paren(Pattern._precedence_level())
 
 
+    @c.production
     def symbol_pattern():
         return (
             Pattern._var().possibly() + symbol() +
@@ -619,6 +736,7 @@ class Pattern:
             Pattern._var().possibly() + Pattern.precedence_level().possibly()
             )
     
+    @c.production
     def binary_symbol_pattern():
         """Parser for binary symbol pattern.
         
@@ -633,6 +751,7 @@ class Pattern:
 
 class Macro:
     
+    @c.production
     def insection():
         """Parser for in-section scoping.
         
@@ -647,6 +766,7 @@ class Macro:
             return acc[0][1]
         return prs.treat(tr)
         
+    @c.production
     def we_record_def():
         """Parser for registered facts.
         
@@ -656,6 +776,7 @@ class Macro:
             return (tok.value not in [',','.',';'])
         return lit('we-record') + c.balanced_condition(p)
             
+    @c.production
     def copula():
         """Parser for copula in macro declarations.
         """
@@ -665,42 +786,52 @@ class Macro:
             (lit('denote'))
             )
                
+    @c.production
     def function_copula():
         return (
             Macro.copula() |
             opt_colon_type() + next_value(':=')
             )
 
+    @c.production
     def iff_junction():
         return lit('iff')
     
+    @c.production
     def opt_say():
         return lit('we-say').possibly()
     
+    @c.production
     def opt_record():
         return lit('we-record').possibly()
     
+    @c.production
     def opt_define():
         return (
             (lit('lets') + next_word('define').possibly()) |
             Macro.opt_record()
             )
     
+    @c.production
     def macro_inferring():
         return c.paren(next_word_inferring() + var().plus() + opt_colon_sort_meta())
     
+    @c.production
     def classifier_word_pattern():  # was classifier_words
         return c.comma_nonempty_list(c.next_any_word_except(['is','are','be']).plus())
     
+    @c.production
     def classifier_def():
         return (
             next_word('let') + Pattern.classifier_word_pattern() +
             lit('is') + lit('a').possibly() + lit('classifier')
             )
     
+    @c.production
     def symbol_type_pattern():
         return Pattern.symbol_pattern()
     
+    @c.production
     def identifier_pattern():
         ##XX
         return (lit('a') + identifier().if_test(p)) | next_value('_')
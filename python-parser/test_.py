@@ -62,8 +62,30 @@ def test_singular():
     for key in singular:
         assert_true('singular.'+key,lexer.singularize(key)==singular[key])
 
+def test_singular_cached():
+    for key in list(singular) + ['Bosses','Theorems','cases']:
+        assert lexer.singularize(key) == lexer.singularize_uncached(key)
+    assert len(lexer.vocabulary) > 0
+    assert lexer.load_vocabulary('/nonexistent/vocabulary.json') == 0
+    
+test_singular_cached()
+
+def test_source_map():
+    s = 'ab cd\n\n  "x\ny" e\nlast'
+    sm = lexer.SourceMap(s)
+    assert len(sm) == 5 and sm.line_text(3) == '  "x' and sm.line_text(5) == 'last'
+    for pos in range(len(s)):
+        line = s.count('\n',0,pos) + 1
+        col = pos - (s.rfind('\n',0,pos) + 1) + 1
+        assert sm.location(pos) == (line,col)
+    toks = lexer.lex_string(s)
+    assert lexer.find_column(s,toks[-1]) == 1
+    assert sm.stream_location(toks,len(toks)) == (5,5)
+    
+test_source_map()
+
 def print_tokens(s:str):
-    lexer.lex.lineno=1
+    lexer.tokenizer.lineno=1
     lexer.tokenizer.input(s)
     p = ''
     for tok in lexer.tokenizer:
@@ -111,6 +133,19 @@ def test_tok():
         
 test_tok()
 
+def test_lex_buffer():
+    s = 'a "long\n\nstring % not comment" b % comment " \nc / d\n\n  e\n'
+    lexer.tokenizer.lineno = 1
+    lexer.tokenizer.input(s)
+    whole = [(t.type,t.value,t.lineno,t.lexpos) for t in lexer.tokenizer]
+    for chunk_size in [1,2,5,100]:
+        ts = lexer.lex_buffer(s.encode('utf-8'),chunk_size)
+        assert [(t.type,t.value,t.lineno,t.lexpos) for t in ts] == whole
+    assert lexer.safe_cut(b'a "b\nc" \nd') == 9
+    assert lexer.safe_cut(b'a "b\nc\nd') is None
+    
+test_lex_buffer()
+
 #print(lexer.tokenizer.__dict__)
 
 #lexer.tokenizer.input("this is it.")
@@ -0,0 +1,355 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Compiled backend for parsers built with parser_combinator.
+
+compile(pr) lowers the graph of Parse nodes under pr to a flat table
+of instructions, run by a single interpreter loop over an integer
+cursor into the token stream, in place of the chain of step closures.
+
+Each Parse node becomes a subroutine, entered by CALL and left by RET.
+The machine has registers pos and acc, playing the part of
+item.pos and item.acc, a stack of partial results, a return stack,
+and a stack of backtrack frames.  A frame saves the registers and
+stack heights; a failure unwinds to the nearest frame that catches it.
+
+Nodes of a kind the compiler does not know (Parse(f), reparse,
+phrases, ...) run through their own step, on an item built from
+the registers.
+
+The compiled program returns the same acc and pos as the parser,
+but keeps no history.  On failure the parser itself is rerun,
+so that errors are the same as in the closure engine.
+Parsers with side effects (see Parse.nomemo) are not compiled:
+their programs just call process.
+"""
+
+from parser_combinator import Parse, Item, History, Failure
+from lexer import TokenSpan
+
+# opcodes
+(CALL, RET, TOKEN, TEST, TREAT, PUSH, PAIR, TUPLE, LIST, ALT, ALTDONE,
+ CHOICE, COMMIT, LOOPINIT, APPEND, LOOPNEXT, LOOPEND, WRAP, NEWLIST,
+ SAVE, RESTORE, FINISHED, NOCATCH, NATIVE, HALT, SPAN) = range(26)
+
+# failures
+NORMAL, EOS, NOCATCHING = range(3)
+
+# what a frame does with an EOS failure (the closure engine's StopIteration)
+PASS, CATCH, STOP = range(3)
+
+# frames
+FRAME_CHOICE, FRAME_ALT = range(2)
+
+# kinds that run their only child unchanged, at the level of acc
+_transparent = {'expect','forward'}
+
+def _none(_):
+    return None
+
+class Compiler:
+    """Lower a Parse graph to instructions.
+
+    Call operands are labels, one per node, and are patched to
+    addresses once every node reached has been emitted."""
+
+    def __init__(self):
+        self.code = []
+        self.labels = {} # id(node) -> label
+        self.nodes = []  # label -> node
+        self.addr = []   # label -> address
+
+    def _resolve(self,p):
+        """skip nodes with no effect on acc"""
+        while p.kind in _transparent and len(p.children) > 0:
+            p = p.children[0]
+        return p
+
+    def label(self,p):
+        p = self._resolve(p)
+        lab = self.labels.get(id(p))
+        if lab is None:
+            lab = len(self.nodes)
+            self.labels[id(p)] = lab
+            self.nodes.append(p)
+        return lab
+
+    def emit(self,op,a=None,b=None):
+        self.code.append((op,a,b))
+        return len(self.code) - 1
+
+    def patch(self,at,op,a=None,b=None):
+        self.code[at] = (op,a,b)
+
+    def call(self,p):
+        """Run p; a bare next_token is inlined"""
+        p = self._resolve(p)
+        if p.kind == 'next_token':
+            self.emit(TOKEN)
+        else:
+            self.emit(CALL,self.label(p))
+
+    def compile(self,pr):
+        self.emit(CALL,self.label(pr))
+        self.emit(HALT)
+        lab = 0
+        while lab < len(self.nodes):
+            self.addr.append(len(self.code))
+            self.node(self.nodes[lab])
+            lab += 1
+        for (at,(op,a,b)) in enumerate(self.code):
+            if op == CALL:
+                self.code[at] = (op,self.addr[a],b)
+            elif op == ALT:
+                self.code[at] = (op,tuple(self.addr[x] for x in a),b)
+        return self.code
+
+    def node(self,p):
+        """Emit the subroutine for p"""
+        kind, cs = p.kind, p.children
+        if kind == 'next_token':
+            self.emit(TOKEN)
+        elif kind == 'if_test':
+            self.call(cs[0])
+            self.emit(TEST,p.arg)
+        elif kind == 'treat':
+            self.call(cs[0])
+            self.emit(TREAT,p.arg)
+        elif kind == 'add':
+            self.call(cs[0])
+            for c in cs[1:]:
+                self.emit(PUSH)
+                self.call(c)
+                self.emit(PAIR)
+        elif kind in ('seq','all'):
+            for c in cs:
+                self.call(c)
+                self.emit(PUSH)
+            if kind == 'seq':
+                self.emit(TUPLE,len(cs))
+            else:
+                self.emit(LIST,len(cs))
+        elif kind in ('or','first'):
+            self.alternatives(cs,Parse._dispatch(cs),PASS)
+        elif kind == 'gen_first':
+            (prs_gen,args) = p.arg
+            # the generator stops at a StopIteration from a parser
+            self.alternatives(list(prs_gen(*args)),None,STOP)
+        elif kind == 'repeat':
+            self.emit(LOOPINIT)
+            for _ in range(p.arg):
+                self.call(cs[0])
+                self.emit(APPEND)
+            at = self.emit(CHOICE)
+            self.call(cs[0])
+            self.emit(APPEND)
+            self.emit(LOOPNEXT,at)
+            self.patch(at,CHOICE,self.emit(LOOPEND),CATCH)
+        elif kind == 'skip':
+            for _ in range(p.arg):
+                self.call(cs[0])
+            at = self.emit(CHOICE)
+            self.call(cs[0])
+            self.emit(LOOPNEXT,at)
+            self.patch(at,CHOICE,self.emit(TREAT,_none),CATCH)
+        elif kind == 'span':
+            self.emit(SAVE)
+            self.call(cs[0])
+            self.emit(SPAN)
+        elif kind == 'possibly':
+            at = self.emit(CHOICE)
+            self.call(cs[0])
+            at1 = self.emit(COMMIT)
+            self.patch(at,CHOICE,self.emit(NEWLIST),PASS)
+            self.emit(RET)
+            self.patch(at1,COMMIT,self.emit(WRAP))
+        elif kind == 'nocatch':
+            at = self.emit(CHOICE)
+            self.call(cs[0])
+            at1 = self.emit(COMMIT)
+            self.patch(at,CHOICE,self.emit(NOCATCH,p.arg),PASS)
+            self.patch(at1,COMMIT,len(self.code))
+        elif kind == 'probe':
+            self.emit(SAVE)
+            self.call(cs[0])
+            self.emit(RESTORE)
+        elif kind == 'commit':
+            self.emit(SAVE)
+            self.call(cs[0])
+            self.emit(RESTORE)
+            self.call(cs[1])
+        elif kind == 'finished':
+            self.emit(FINISHED)
+        elif kind in ('identity','history','clear_history'):
+            pass # history parsers do not run their child
+        else:
+            self.emit(NATIVE,p)
+        self.emit(RET)
+
+    def alternatives(self,prs,candidates,eos):
+        self.emit(ALT,[self.label(q) for q in prs],(candidates,eos))
+        self.emit(ALTDONE)
+
+
+class Program:
+    """A compiled parser.  process:Item->Item as for Parse.process"""
+
+    def __init__(self,pr):
+        self.parser = pr
+        self.native = not(pr.pure)
+        self.code = [] if self.native else Compiler().compile(pr)
+
+    def process(self,item):
+        if self.native:
+            return self.parser.process(item)
+        r = self.run(item.stream,item.pos,item.acc)
+        if r is None:
+            return self.parser.process(item) # raises the parser's error
+        (pos,acc) = r
+        return Item(stream=item.stream,pos=pos,acc=acc,history=item.history)
+
+    def run(self,stream,pos,acc):
+        """Run from registers pos and acc.
+        Returns (pos,acc), or None on failure."""
+        code = self.code
+        n = len(stream)
+        vals, ret, bt = [], [], []
+        pc = 0
+        while True:
+            (op,a,b) = code[pc]
+            pc += 1
+            if op == CALL:
+                ret.append(pc)
+                pc = a
+                continue
+            if op == RET:
+                pc = ret.pop()
+                continue
+            if op == TOKEN:
+                if pos < n:
+                    acc = stream[pos]
+                    pos += 1
+                    continue
+                err = EOS
+            elif op == TEST:
+                if a(acc):
+                    continue
+                err = NORMAL
+            elif op == TREAT:
+                acc = a(acc)
+                continue
+            elif op == PUSH:
+                vals.append(acc)
+                continue
+            elif op == PAIR:
+                acc = (vals.pop(),acc)
+                continue
+            elif op == ALT:
+                (candidates,eos) = b
+                if candidates is not None and pos < n:
+                    idxs = candidates(stream[pos])
+                    addrs = tuple(a[i] for i in idxs)
+                else:
+                    addrs = a
+                if len(addrs) > 0:
+                    bt.append((FRAME_ALT,pc,pos,acc,len(vals),len(ret),eos,addrs,0))
+                    ret.append(pc)
+                    pc = addrs[0]
+                    continue
+                err = NORMAL
+            elif op == ALTDONE:
+                bt.pop()
+                continue
+            elif op == CHOICE:
+                bt.append((FRAME_CHOICE,a,pos,acc,len(vals),len(ret),b,None,0))
+                continue
+            elif op == COMMIT:
+                bt.pop()
+                pc = a
+                continue
+            elif op == LOOPINIT:
+                vals.append([])
+                continue
+            elif op == APPEND:
+                vals[-1].append(acc)
+                continue
+            elif op == LOOPNEXT:
+                if bt.pop()[2] != pos: # progress, go around again
+                    pc = a
+                continue
+            elif op == LOOPEND:
+                acc = vals.pop()
+                continue
+            elif op == TUPLE:
+                acc = tuple(vals[len(vals)-a:])
+                del vals[len(vals)-a:]
+                continue
+            elif op == LIST:
+                acc = vals[len(vals)-a:]
+                del vals[len(vals)-a:]
+                continue
+            elif op == WRAP:
+                acc = [acc]
+                continue
+            elif op == NEWLIST:
+                acc = []
+                continue
+            elif op == SAVE:
+                vals.append((pos,acc))
+                continue
+            elif op == RESTORE:
+                (pos,acc) = vals.pop()
+                continue
+            elif op == SPAN:
+                acc = TokenSpan(stream,vals.pop()[0],pos)
+                continue
+            elif op == FINISHED:
+                if pos >= n:
+                    continue
+                err = NORMAL
+            elif op == NOCATCH:
+                err = NOCATCHING
+            elif op == NATIVE:
+                try:
+                    r = a.step(Item(stream,pos,acc,History.empty))
+                except StopIteration:
+                    r = None
+                if r is None:
+                    err = EOS
+                elif r.__class__ is Failure:
+                    err = NORMAL if r.msg is None else NOCATCHING
+                else:
+                    pos, acc = r.pos, r.acc
+                    continue
+            elif op == HALT:
+                return (pos,acc)
+            # failure: unwind to a frame that catches err
+            while True:
+                if len(bt) == 0:
+                    return None
+                (fk,resume,fpos,facc,nvals,nret,eos,addrs,k) = bt.pop()
+                if err == NOCATCHING:
+                    continue
+                if err == EOS:
+                    if eos == PASS:
+                        continue
+                    if eos == STOP:
+                        err = NORMAL
+                        continue
+                pos, acc = fpos, facc
+                del vals[nvals:]
+                del ret[nret:]
+                if fk == FRAME_CHOICE:
+                    pc = resume
+                    break
+                k += 1
+                if k < len(addrs):
+                    bt.append((fk,resume,fpos,facc,nvals,nret,eos,addrs,k))
+                    ret.append(resume)
+                    pc = addrs[k]
+                    break
+                err = NORMAL
+
+def compile(pr):
+    """Compile a parser to a Program"""
+    return Program(pr)
@@ -0,0 +1,76 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Build the vocabulary table of singular forms loaded by lexer at startup.
+
+Every word of the corpus files (as lexed into WORD tokens) and of
+word_lists is mapped to its singular form, as written, so that
+lexer.singularize costs one dictionary lookup on them.
+
+usage: python vocabulary.py [corpus files or directories]
+The default corpus is sample-texts/planet-math-11 and parser/scripts.
+The table is written to lexer.VOCABULARY_FILE.
+"""
+
+import sys
+import os
+import re
+import json
+import lexer
+import word_lists
+
+here = os.path.dirname(os.path.abspath(__file__))
+
+default_corpus = [os.path.normpath(os.path.join(here,'..','sample-texts','planet-math-11')),
+                  os.path.normpath(os.path.join(here,'..','parser','scripts'))]
+
+def corpus_files(paths,suffixes=None):
+    """files under the directories of paths (those with one of the
+    suffixes, if given), sorted, and the other paths as given"""
+    for path in paths:
+        if os.path.isdir(path):
+            for (d,_,fs) in sorted(os.walk(path)):
+                for f in sorted(fs):
+                    if suffixes is None or f.endswith(suffixes):
+                        yield os.path.join(d,f)
+        else:
+            yield path
+
+identifier = re.compile(lexer.t_ATOMIC_IDENTIFIER.__doc__)
+
+def corpus_words(paths):
+    """raw words of the files, as they come out of the lexer"""
+    ws = set()
+    for f in corpus_files(paths):
+        try:
+            with open(f,encoding='utf-8') as fp:
+                text = fp.read()
+        except (OSError,UnicodeDecodeError):
+            continue
+        ws.update(m.group() for m in identifier.finditer(text)
+                  if lexer.is_word.fullmatch(m.group()))
+    return ws
+
+def list_words():
+    ws = set()
+    for ls in [word_lists.invariable,word_lists.transition,
+               word_lists.preposition_list]:
+        for phrase in ls:
+            ws.update(phrase.split())
+    return ws
+
+def build(paths):
+    words = corpus_words(paths).union(list_words())
+    words = words.union(w.lower() for w in words)
+    return {w : lexer.singularize_uncached(w) for w in sorted(words)}
+
+def main(argv):
+    paths = argv[1:] or default_corpus
+    table = build(paths)
+    with open(lexer.VOCABULARY_FILE,'w',encoding='utf-8') as fp:
+        json.dump({'fingerprint' : lexer.vocabulary_fingerprint(),'words' : table},
+                  fp,indent=0,sort_keys=True)
+    print(f'{len(table)} words written to {lexer.VOCABULARY_FILE}')
+
+if __name__ == '__main__':
+    main(sys.argv)